@@ -0,0 +1,134 @@
+"""
+bench_info_parse.py — Micro-benchmark for lc0 "info" line parsing
+
+Compares the previous split-and-index parsing of every info line against
+parsing every line with parse_info_line(), and against what analyse() does
+now: keep the newest raw line per MultiPV slot and parse those once at
+bestmove. Runs on recorded lc0 output.
+
+Usage:
+    python bench_info_parse.py                  # built-in MultiPV 3 sample
+    python bench_info_parse.py lc0_server.log   # "← lc0#1: info …" lines from a
+                                                # log written with DEBUG level
+"""
+
+import re
+import sys
+import timeit
+
+from lc0_server import UCIEngine, info_int, parse_info_line
+
+# Recorded from lc0 (BT4, MultiPV 3) analysing the position after 1. e4 c5.
+SAMPLE = """\
+info depth 1 seldepth 2 time 38 nodes 4 score cp 31 wdl 103 851 46 nps 105 tbhits 0 multipv 1 pv g1f3 d7d6
+info depth 1 seldepth 2 time 38 nodes 4 score cp 24 wdl 91 863 46 nps 105 tbhits 0 multipv 2 pv b1c3 b8c6
+info depth 1 seldepth 2 time 38 nodes 4 score cp 19 wdl 84 866 50 nps 105 tbhits 0 multipv 3 pv c2c3 g8f6
+info depth 5 seldepth 11 time 412 nodes 1876 score cp 33 wdl 107 848 45 nps 4553 tbhits 0 multipv 1 pv g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3
+info depth 5 seldepth 11 time 412 nodes 1876 score cp 22 wdl 88 864 48 nps 4553 tbhits 0 multipv 2 pv b1c3 b8c6 g1f3 e7e6 d2d4
+info depth 5 seldepth 11 time 412 nodes 1876 score cp 20 wdl 86 865 49 nps 4553 tbhits 0 multipv 3 pv c2c3 g8f6 e4e5 f6d5 d2d4 c5d4
+info depth 9 seldepth 27 time 1207 nodes 11904 score cp 32 wdl 105 849 46 hashfull 19 nps 9862 tbhits 0 multipv 1 pv g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3 a7a6 c1e3 e7e5 d4b3 c8e6 f2f3
+info depth 9 seldepth 27 time 1207 nodes 11904 score cp 23 wdl 90 862 48 hashfull 19 nps 9862 tbhits 0 multipv 2 pv b1c3 b8c6 g1f3 e7e6 d2d4 c5d4 f3d4 d8c7 c1e3 a7a6
+info depth 9 seldepth 27 time 1207 nodes 11904 score cp 18 wdl 82 868 50 hashfull 19 nps 9862 tbhits 0 multipv 3 pv c2c3 g8f6 e4e5 f6d5 d2d4 c5d4 g1f3 b8c6 c3d4 d7d6 f1c4
+info depth 12 seldepth 38 time 1843 nodes 21387 score cp 31 wdl 103 851 46 hashfull 36 nps 11604 tbhits 0 multipv 1 pv g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3 a7a6 c1e3 e7e5 d4b3 c8e6 f2f3 f8e7 d1d2
+info depth 12 seldepth 38 time 1843 nodes 21387 score cp 24 wdl 91 861 48 hashfull 36 nps 11604 tbhits 0 multipv 2 pv b1c3 b8c6 g1f3 e7e6 d2d4 c5d4 f3d4 d8c7 c1e3 a7a6 d1d2 g8f6
+info depth 12 seldepth 38 time 1843 nodes 21387 score cp 17 wdl 80 869 51 hashfull 36 nps 11604 tbhits 0 multipv 3 pv c2c3 g8f6 e4e5 f6d5 d2d4 c5d4 g1f3 b8c6 c3d4 d7d6 f1c4 d5b6 c4b5
+""".splitlines()
+
+
+def legacy_parse(line: str, mpv: dict, state: list):
+    """The parsing analyse() + _parse_info() did before parse_info_line()."""
+    parts = line.split()
+    try:
+        if "depth" in parts:
+            d = int(parts[parts.index("depth") + 1])
+            if d > state[0]:
+                state[0] = d
+        if "nodes" in parts:
+            state[1] = int(parts[parts.index("nodes") + 1])
+    except (ValueError, IndexError):
+        pass
+
+    parts = line.split()
+    slot = 1
+    if "multipv" in parts:
+        try:
+            slot = int(parts[parts.index("multipv") + 1])
+        except (ValueError, IndexError):
+            pass
+    if slot not in mpv:
+        mpv[slot] = {"score_cp": None, "score_mate": None, "pv": [], "move": None}
+    try:
+        if "score" in parts:
+            si   = parts.index("score")
+            kind = parts[si + 1]
+            val  = int(parts[si + 2])
+            if kind == "cp":
+                mpv[slot]["score_cp"]   = val
+                mpv[slot]["score_mate"] = None
+            elif kind == "mate":
+                mpv[slot]["score_mate"] = val
+                mpv[slot]["score_cp"]   = None
+        if "pv" in parts:
+            pi = parts.index("pv")
+            pv = parts[pi + 1:]
+            mpv[slot]["pv"]   = pv
+            mpv[slot]["move"] = pv[0] if pv else None
+    except (ValueError, IndexError):
+        pass
+
+
+def current_parse(engine: UCIEngine, line: str, mpv: dict, state: list):
+    info = parse_info_line(line)
+    if info is None:
+        return
+    if info.depth is not None and info.depth > state[0]:
+        state[0] = info.depth
+    if info.nodes is not None:
+        state[1] = info.nodes
+    engine._parse_info(info, mpv)
+
+
+def load_lines(path: str) -> list:
+    received = re.compile(r"← lc0\S*: (info .*)")
+    lines    = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for raw in f:
+            m = received.search(raw)
+            if m:
+                lines.append(m.group(1).rstrip())
+    return lines
+
+
+def main():
+    lines = load_lines(sys.argv[1]) if len(sys.argv) > 1 else SAMPLE
+    if not lines:
+        sys.exit("No '← lc0#N: info' lines found (was the log written at DEBUG level?)")
+    engine = UCIEngine("lc0")
+
+    def run_legacy():
+        mpv, state = {}, [0, 0]
+        for line in lines:
+            legacy_parse(line, mpv, state)
+
+    def run_single_pass():
+        mpv, state = {}, [0, 0]
+        for line in lines:
+            current_parse(engine, line, mpv, state)
+
+    def run_lazy():
+        latest = {}
+        for line in lines:
+            if " pv " not in line or line.startswith("info string"):
+                continue
+            latest[info_int(line, " multipv ") or 1] = line
+        engine._materialise(latest, "e2e4")
+
+    rounds = max(1, 200_000 // len(lines))
+    for name, fn in (("legacy", run_legacy), ("single-pass", run_single_pass),
+                     ("lazy", run_lazy)):
+        best = min(timeit.repeat(fn, number=rounds, repeat=5))
+        print(f"{name:>12}: {best / (rounds * len(lines)) * 1e6:6.2f} µs/line")
+
+
+if __name__ == "__main__":
+    main()
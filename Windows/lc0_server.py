@@ -20,78 +20,420 @@ Bugs fixed vs previous version:
 """
 
 import asyncio
+import atexit
+import hashlib
+import io
 import json
-import subprocess
-import threading
+import queue
+import sqlite3
 import argparse
 import logging
 import sys
 import os
-from typing import Optional
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Callable, NamedTuple, Optional
 
 import websockets
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(os.path.join(os.path.dirname(__file__), "lc0_server.log")),
-    ],
-)
+try:
+    import chess
+    import chess.pgn
+    import chess.polyglot
+    import chess.syzygy
+except ImportError:     # optional — PGN input, opening book and tablebases
+    chess = None
+
 log = logging.getLogger("lc0_server")
 
+
+def setup_logging(path: str, level: int = logging.INFO,
+                  max_bytes: int = 10 << 20, backups: int = 5) -> QueueListener:
+    """
+    Log to stdout and to path, rotated once it reaches max_bytes. The event
+    loop only puts records on a queue; a listener thread does the console
+    and disk I/O, so a slow disk never stalls a search. Queued records are
+    flushed at exit.
+    """
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    handlers  = [logging.StreamHandler(sys.stdout),
+                 RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                     encoding="utf-8")]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    root    = logging.getLogger()
+    root.handlers[:] = [QueueHandler(records)]
+    root.setLevel(level)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 MULTI_PV = 3
 
 
+# ── UCI Info Lines ────────────────────────────────────────────────────────────
+
+class InfoLine(NamedTuple):
+    """One parsed "info" line. Fields lc0 left out are None."""
+    depth:       Optional[int]
+    seldepth:    Optional[int]
+    nodes:       Optional[int]
+    nps:         Optional[int]
+    multipv:     int                 # 1 when lc0 omits it (MultiPV=1)
+    score_kind:  Optional[str]       # "cp" or "mate"
+    score_value: Optional[int]       # side-to-move perspective
+    bound:       Optional[str]       # "lowerbound" / "upperbound"
+    wdl:         Optional[tuple]     # (win, draw, loss) per mille
+    pv:          list
+
+
+# lc0 always prints info fields in this order; matching it in one regex is
+# cheaper than walking tokens in Python. Anything else takes the slow path.
+_LC0_INFO = re.compile(
+    r"info depth (\d+) seldepth (\d+) time \d+ nodes (\d+) score (cp|mate) (-?\d+)"
+    r"(?: (lowerbound|upperbound))?(?: wdl (\d+) (\d+) (\d+))?(?: movesleft \d+)?"
+    r"(?: hashfull \d+)? nps (\d+) tbhits \d+(?: multipv (\d+))? pv ")
+
+
+def parse_info_line(line: str) -> Optional[InfoLine]:
+    """
+    Parse an "info" line in a single left-to-right pass. Returns None for
+    "info string" chatter and for malformed lines.
+
+    Lines in lc0's usual layout are matched by one regex; any other layout
+    falls back to a token walk. lc0 always prints "pv" last, so everything
+    after it is the PV and the walk stops there.
+    """
+    m = _LC0_INFO.match(line)
+    if m is not None:
+        depth, seldepth, nodes, kind, value, bound, w, d, l, nps, multipv = m.groups()
+        return InfoLine(int(depth), int(seldepth), int(nodes), int(nps),
+                        int(multipv) if multipv else 1, kind, int(value), bound,
+                        (int(w), int(d), int(l)) if w else None, line[m.end():].split())
+
+    tokens = line.split()
+    n      = len(tokens)
+    depth = seldepth = nodes = nps = kind = value = bound = wdl = None
+    multipv = 1
+    pv: list = []
+    i = 1
+    try:
+        while i < n:
+            tok = tokens[i]
+            if tok == "pv":
+                pv = tokens[i + 1:]
+                break
+            elif tok == "depth":
+                depth = int(tokens[i + 1]);    i += 2
+            elif tok == "nodes":
+                nodes = int(tokens[i + 1]);    i += 2
+            elif tok == "multipv":
+                multipv = int(tokens[i + 1]);  i += 2
+            elif tok == "score":
+                kind  = tokens[i + 1]
+                value = int(tokens[i + 2]);    i += 3
+                if i < n and tokens[i] in ("lowerbound", "upperbound"):
+                    bound = tokens[i];         i += 1
+            elif tok == "seldepth":
+                seldepth = int(tokens[i + 1]); i += 2
+            elif tok == "nps":
+                nps = int(tokens[i + 1]);      i += 2
+            elif tok == "wdl":
+                wdl = (int(tokens[i + 1]), int(tokens[i + 2]), int(tokens[i + 3]))
+                i += 4
+            elif tok == "string":
+                return None
+            else:
+                # time / hashfull / tbhits / currmove … — skip key and value
+                i += 2
+    except (ValueError, IndexError):
+        return None
+    return InfoLine(depth, seldepth, nodes, nps, multipv, kind, value, bound, wdl, pv)
+
+
+def info_int(line: str, key: str) -> Optional[int]:
+    """
+    Pull one integer field out of a raw info line without tokenising it.
+    key includes its surrounding spaces, e.g. " multipv ".
+    """
+    i = line.find(key)
+    if i < 0:
+        return None
+    i += len(key)
+    j  = line.find(" ", i)
+    try:
+        return int(line[i:j] if j >= 0 else line[i:])
+    except ValueError:
+        return None
+
+
+# ── Search Budgets ────────────────────────────────────────────────────────────
+
+class SearchBudget(NamedTuple):
+    """
+    How much search a request buys. "movetime" (ms), "nodes" and "depth"
+    map straight onto "go movetime/nodes/depth"; "infinite" is "go infinite"
+    stopped by the server after value ms. deadline_ms caps the wall time
+    of a nodes or depth search.
+    """
+    kind:        str
+    value:       int
+    deadline_ms: Optional[int] = None
+
+    def __str__(self) -> str:
+        if self.kind == "movetime":
+            return f"movetime={self.value}ms"
+        if self.kind == "infinite":
+            return f"infinite, stop after {self.value}ms"
+        return f"{self.kind}={self.value}"
+
+    @property
+    def go(self) -> str:
+        return "go infinite" if self.kind == "infinite" else f"go {self.kind} {self.value}"
+
+    @property
+    def stop_after_ms(self) -> Optional[int]:
+        """When the server has to send "stop" itself, if ever."""
+        if self.kind == "infinite":
+            return self.value
+        return None if self.kind == "movetime" else self.deadline_ms
+
+    @property
+    def cache_kind(self) -> str:
+        """Budgets whose amounts compare: a longer search answers a shorter one."""
+        return "movetime" if self.kind == "infinite" else self.kind
+
+
+BUDGET_KINDS = ("movetime", "nodes", "depth", "infinite")
+
+
+# ── Adaptive Search Time ──────────────────────────────────────────────────────
+
+class AdaptiveTime:
+    """
+    Per-request time policy: movetime_ms is the normal budget, max_ms the
+    most a hard position may get. lc0 is sent "go movetime <max_ms>" and
+    should_stop() decides, from the live MultiPV lines, when to cut it short:
+
+      - after min_ms, if the best move has held for the last half of the
+        search and leads the 2nd-best move by easy_gap_cp or more;
+      - at movetime_ms, if it has held and leads by close_gap_cp or more.
+
+    Otherwise (a close race, or a best move that keeps changing) lc0 runs on
+    up to max_ms.
+    """
+
+    def __init__(self, movetime_ms: int, max_ms: Optional[int] = None,
+                 min_fraction: float = 0.25, easy_gap_cp: int = 150,
+                 close_gap_cp: int = 40):
+        self.movetime_ms  = movetime_ms
+        self.max_ms       = max(movetime_ms, max_ms or 2 * movetime_ms)
+        self.min_ms       = int(movetime_ms * min_fraction)
+        self.easy_gap_cp  = easy_gap_cp
+        self.close_gap_cp = close_gap_cp
+        self.elapsed_ms   = 0            # how long the search actually ran
+        self._best: Optional[str] = None
+        self._best_since  = 0.0
+
+    def should_stop(self, elapsed_ms: float, latest: dict) -> bool:
+        """latest is analyse()'s slot → newest raw info line."""
+        line = latest.get(1)
+        if line is None:
+            return False
+        first = parse_info_line(line)
+        if first is None or not first.pv:
+            return False
+        if first.pv[0] != self._best:
+            self._best, self._best_since = first.pv[0], elapsed_ms
+        if elapsed_ms < self.min_ms or elapsed_ms - self._best_since < elapsed_ms / 2:
+            return False
+        gap = self._gap(first, latest.get(2))
+        if gap is None:
+            return False
+        if gap >= self.easy_gap_cp:
+            return True
+        return elapsed_ms >= self.movetime_ms and gap >= self.close_gap_cp
+
+    @staticmethod
+    def _gap(first: InfoLine, line: Optional[str]) -> Optional[float]:
+        """Best minus 2nd-best score in cp; a mate for the mover is infinite."""
+        if first.score_kind == "mate":
+            return float("inf") if first.score_value > 0 else None
+        second = parse_info_line(line) if line else None
+        if second is None or second.score_kind is None:
+            return None
+        if second.score_kind == "mate":
+            return None if second.score_value > 0 else float("inf")
+        return first.score_value - second.score_value
+
+
+# ── Early Termination ─────────────────────────────────────────────────────────
+
+class EarlyStop:
+    """
+    Thresholds for stopping a search whose result can no longer meaningfully
+    change. for_search() gives the per-search tracker, which asks for a stop
+    when slot 1 has reported the same forced mate mate_updates times in a
+    row, or when lc0 is past only_move_nodes nodes and still reports a single
+    slot (with MultiPV > 1 it reports one per legal move, so that move is
+    forced). A threshold of 0 turns its rule off.
+    """
+
+    def __init__(self, mate_updates: int = 3, only_move_nodes: int = 100):
+        self.mate_updates    = mate_updates
+        self.only_move_nodes = only_move_nodes
+        self.multipv         = 1
+        self._mate: Optional[int] = None
+        self._mate_run = 0
+
+    def for_search(self, multipv: int) -> "EarlyStop":
+        tracker = EarlyStop(self.mate_updates, self.only_move_nodes)
+        tracker.multipv = multipv
+        return tracker
+
+    def reason(self, slot: int, line: str, latest: dict) -> Optional[str]:
+        """
+        Why the search should stop now, or None. Called with each new info
+        line before it replaces its slot in latest.
+        """
+        if slot != 1:
+            return None
+        # A slot-1 line after a whole round of updates with no slot 2 in it
+        if (self.only_move_nodes and self.multipv > 1 and 1 in latest
+                and 2 not in latest
+                and (info_int(latest[1], " nodes ") or 0) >= self.only_move_nodes):
+            return "only move"
+        mate = info_int(line, " mate ")
+        if mate is None or mate != self._mate:
+            self._mate, self._mate_run = mate, 0
+        if mate is not None:
+            self._mate_run += 1
+            if self.mate_updates and self._mate_run >= self.mate_updates:
+                return f"mate {mate} is stable"
+        return None
+
+
 # ── UCI Engine ────────────────────────────────────────────────────────────────
 
+class EngineCrashed(RuntimeError):
+    """lc0 exited, or stopped answering, while a request needed it."""
+
+
+_EXITED = object()   # queued by _reader() once lc0's stdout closes
+
+
 class UCIEngine:
     """
     Wraps lc0.exe via UCI protocol.
-    All engine calls must be serialised through Lc0Server._engine_lock.
+    A search must only run while the engine is checked out of its EnginePool.
+
+    Searches are numbered in the order their "go" is sent. lc0 answers each
+    with exactly one "bestmove", so _reader() tags every line with the
+    number of the search it belongs to (one more than the bestmoves seen so
+    far), and a search only ever reads its own output: a bestmove that
+    arrives late from a search abandoned after a timeout is skipped, not
+    taken as the next search's answer.
+
+    If lc0 goes quiet for stall_after seconds during a search it is sent
+    "isready"; if that gets no answer within another stall_after seconds
+    the process is killed. Either way the search raises EngineCrashed and
+    `exited` is set, for an EngineSupervisor to restart it.
     """
 
-    def __init__(self, lc0_path: str, model_path: Optional[str] = None):
+    def __init__(self, lc0_path: str, model_path: Optional[str] = None,
+                 name: str = "lc0", early_stop: Optional[EarlyStop] = None,
+                 stall_after: float = 5.0, info_log_every: int = 1):
         self.lc0_path   = lc0_path
         self.model_path = model_path
-        self._proc:  Optional[subprocess.Popen] = None
+        self.name       = name
+        self.early_stop = early_stop
+        self.stall_after = stall_after   # 0 disables stall detection
+        self.info_log_every = max(1, info_log_every)   # DEBUG sampling of info lines
+        self._info_lines    = 0
+        self.options: dict = {}   # every setoption sent, by name
+        self.exited  = asyncio.Event()
+        self.closing = False      # stop() called: an exit is not a crash
+        self._killed = False
+        self._proc:  Optional[asyncio.subprocess.Process] = None
         self._ready  = asyncio.Event()
-        self._queue: asyncio.Queue = asyncio.Queue()
-        self._loop:  Optional[asyncio.AbstractEventLoop] = None
+        self._queue: asyncio.Queue = asyncio.Queue()   # (search number, line)
+        self._started  = 0        # "go" commands sent …
+        self._finished = 0        # … and "bestmove" lines received
+        self._tasks: list = []
+        self._searching = False   # between "go" and its "bestmove"
+        self._new_game_pending = False
+        self._pondering = False   # between "go ponder" and "ponderhit"
+        self._ponder_started: Optional[float] = None
+        self._stop_at:        Optional[float] = None
 
     # ── Startup ────────────────────────────────────────────────────────────
 
-    def start(self, loop: asyncio.AbstractEventLoop):
-        self._loop = loop
+    async def start(self):
         cmd = [self.lc0_path]
         if self.model_path:
             cmd += ["--weights", self.model_path]
-        log.info("Launching: %s", " ".join(cmd))
-        self._proc = subprocess.Popen(
-            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, text=True, bufsize=1,
+        log.info("Launching %s: %s", self.name, " ".join(cmd))
+        self.exited.clear()
+        self._killed = False
+        # lc0 output lines (long MultiPV PVs) can exceed the 64 KiB default
+        self._proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, limit=1 << 20,
         )
-        threading.Thread(target=self._reader, daemon=True).start()
+        self._tasks = [asyncio.create_task(self._reader()),
+                       asyncio.create_task(self._stderr_reader())]
         self._send("uci")
 
     def _send(self, line: str):
-        if self._proc and self._proc.stdin:
-            self._proc.stdin.write(line + "\n")
-            self._proc.stdin.flush()
-            log.debug("→ lc0: %s", line)
-
-    def _reader(self):
-        """Background thread: pipe lc0 stdout into the asyncio queue."""
-        for raw in iter(self._proc.stdout.readline, ""):
-            line = raw.rstrip()
+        # StreamWriter.write() only buffers; the transport flushes it without
+        # blocking the event loop, and UCI commands are far too small to
+        # ever need drain().
+        if self._proc and self._proc.stdin and not self._proc.stdin.is_closing():
+            self._proc.stdin.write((line + "\n").encode())
+            log.debug("→ %s: %s", self.name, line)
+
+    async def _reader(self):
+        """Pipe lc0 stdout into the queue, one line at a time."""
+        stdout = self._proc.stdout
+        while raw := await stdout.readline():
+            line = raw.decode(errors="replace").rstrip()
             if not line:
                 continue
-            log.debug("← lc0: %s", line)
+            if log.isEnabledFor(logging.DEBUG):
+                # info lines are most of the traffic; keep 1 in info_log_every
+                self._info_lines += line.startswith("info")
+                if not line.startswith("info") or self._info_lines % self.info_log_every == 0:
+                    log.debug("← %s: %s", self.name, line)
             if line == "uciok":
-                self._loop.call_soon_threadsafe(self._ready.set)
-            self._loop.call_soon_threadsafe(self._queue.put_nowait, line)
-        log.warning("lc0 stdout closed")
+                self._ready.set()
+            self._queue.put_nowait((self._finished + 1, line))
+            if line.startswith("bestmove"):
+                self._finished += 1
+        log.warning("%s stdout closed", self.name)
+        self._queue.put_nowait(_EXITED)
+        self.exited.set()
+
+    @property
+    def alive(self) -> bool:
+        return self._proc is not None and not self._killed and not self.exited.is_set()
+
+    def kill(self):
+        """End a hung lc0 process; _reader() then sees its stdout close."""
+        if self._proc and self._proc.returncode is None:
+            self._killed = True
+            self._proc.kill()
+
+    async def _stderr_reader(self):
+        """lc0 logs backend details on stderr; keep the pipe from filling up."""
+        while raw := await self._proc.stderr.readline():
+            line = raw.decode(errors="replace").rstrip()
+            if line:
+                log.debug("%s stderr: %s", self.name, line)
 
     # ── Handshake ──────────────────────────────────────────────────────────
 
@@ -103,103 +445,302 @@ class UCIEngine:
         await self._ready.wait()   # waits for "uciok"
         self._send("isready")
         while True:
-            line = await self._queue.get()
-            if line == "readyok":
-                log.info("lc0 ready")
+            item = await self._queue.get()
+            if item is _EXITED:
+                raise EngineCrashed(f"{self.name} exited during the UCI handshake")
+            if item[1] == "readyok":
+                log.info("%s ready", self.name)
                 return
 
     def new_game(self):
-        """Send ucinewgame to clear lc0's hash between games."""
-        self._send("ucinewgame")
+        """
+        Send ucinewgame to clear lc0's hash between games. If a search is
+        running it is sent right before the next one instead.
+        """
+        if self._searching:
+            self._new_game_pending = True
+        else:
+            self._send("ucinewgame")
 
     def set_option(self, name: str, value: str):
+        self.options[name] = value
         self._send(f"setoption name {name} value {value}")
 
+    async def restart(self, timeout: float = 60.0):
+        """
+        Replace a dead or hung lc0 process with a new one: handshake again
+        and resend every option set so far. Raises EngineCrashed, OSError or
+        asyncio.TimeoutError if the new process does not come up either.
+        """
+        self.kill()
+        if self._proc:
+            await self._proc.wait()
+        for task in self._tasks:
+            task.cancel()
+        self._queue = asyncio.Queue()
+        self._started = self._finished = 0
+        self._ready.clear()
+        self._end_search()
+        self._new_game_pending = False
+        await self.start()
+        await asyncio.wait_for(self.wait_ready(), timeout)
+        for name, value in self.options.items():
+            self._send(f"setoption name {name} value {value}")
+
     # ── Analysis ───────────────────────────────────────────────────────────
 
-    async def analyse(self, fen: str, movetime_ms: int = 2000) -> dict:
-        """
-        Analyse FEN with MultiPV. Caller MUST hold Lc0Server._engine_lock.
+    async def analyse(self, fen: str, movetime_ms: int = 2000,
+                      on_update: Optional[Callable[[dict], None]] = None,
+                      update_interval: float = 0.1,
+                      moves: Optional[list] = None,
+                      adaptive: Optional[AdaptiveTime] = None,
+                      budget: Optional[SearchBudget] = None,
+                      ponder: bool = False,
+                      timings: Optional["RequestTimings"] = None) -> dict:
         """
-        # Drain any stale output from previous commands
-        while not self._queue.empty():
-            self._queue.get_nowait()
+        Analyse FEN with MultiPV. Caller MUST have checked this engine out.
 
-        self._send(f"position fen {fen}")
-        self._send(f"go movetime {movetime_ms}")
+        If moves (UCI) are given, the position searched is FEN followed by
+        those moves; sending the game history this way lets lc0 reuse its
+        search tree from the previous ply.
 
-        mpv: dict[int, dict] = {}    # slot → {score_cp, score_mate, pv, move}
-        best_depth = 0
-        best_nodes = 0
-        # Generous timeout: movetime + 15s for MultiPV overhead
-        timeout = (movetime_ms / 1000.0) + 15.0
+        A budget, if given, replaces movetime_ms. With an AdaptiveTime
+        policy lc0 may run up to the policy's max_ms and is stopped as soon
+        as the policy says so.
+
+        With ponder=True the search is sent as "go ponder" and runs until
+        ponderhit() says how long it has left (or an "infinite" budget's
+        deadline passes); pass SearchBudget("infinite", cap_ms).
+
+        If on_update is given it is called with a partial result (same shape
+        as the final one, bestmove taken from slot 1's PV) whenever depth
+        increases or update_interval seconds have passed since the last call.
+        timings, if given, gets the first info line, each new depth and the
+        bestmove.
+        """
+        if not self.alive:
+            raise EngineCrashed(f"{self.name} is not running")
+        await self._settle()
+
+        if self._new_game_pending:
+            self._new_game_pending = False
+            self._send("ucinewgame")
+        position = ("startpos" if normalise_fen(fen) == normalise_fen(START_FEN)
+                    else f"fen {fen}")
+        if moves:
+            self._send(f"position {position} moves {' '.join(moves)}")
+        else:
+            self._send(f"position {position}")
+        if adaptive is not None:
+            budget = SearchBudget("movetime", adaptive.max_ms)
+        elif budget is None:
+            budget = SearchBudget("movetime", movetime_ms)
+        self._send("go ponder" if ponder else budget.go)
+        self._searching = True
+        self._started  += 1
+        search = self._started
+
+        # Only the newest line of each MultiPV slot ends up in the result, so
+        # lines are kept raw and parsed once, when a result is actually built.
+        latest: dict[int, str] = {}   # slot → newest info line with a PV
+        started     = time.monotonic()
+        stop_after  = budget.stop_after_ms
+        # When the server stops lc0 itself; ponderhit() may move it
+        self._stop_at = started + stop_after / 1000.0 if stop_after else None
+        self._pondering, self._ponder_started = ponder, (started if ponder else None)
+        limit_ms    = budget.value if budget.kind == "movetime" else (stop_after or 0)
+        last_update = started
+        last_depth  = 0
+        last_check  = started
+        last_output = started
+        pinged      = False   # "isready" sent after stall_after quiet seconds
+        stopping    = False
+        early = (self.early_stop.for_search(int(self.options.get("MultiPV", 1)))
+                 if self.early_stop else None)
 
         while True:
+            now = time.monotonic()
+            # Generous timeout: movetime (or the stop time) + 15s for MultiPV overhead
+            deadline = (self._stop_at if self._stop_at is not None
+                        else started + limit_ms / 1000.0) + 15.0
+            timeout  = deadline - now
+            if not stopping:
+                if self._stop_at is not None:
+                    if now >= self._stop_at:
+                        self._send("stop")
+                        stopping = True
+                    else:
+                        timeout = min(timeout, self._stop_at - now)
+                if adaptive is not None or ponder:
+                    # Wake up regularly even if lc0 is quiet, to re-check the
+                    # policy or a stop time moved by ponderhit()
+                    timeout = min(timeout, 0.05)
+            if self.stall_after:
+                quiet_until = last_output + self.stall_after * (2 if pinged else 1)
+                if now >= quiet_until:
+                    if pinged:
+                        log.error("%s stopped responding (fen=%s), killing it", self.name, fen)
+                        self.kill()
+                        self._end_search()
+                        raise EngineCrashed(f"{self.name} stopped responding")
+                    self._send("isready")
+                    pinged = True
+                    continue
+                timeout = min(timeout, quiet_until - now)
             try:
-                line = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                item = await asyncio.wait_for(self._queue.get(), timeout=max(timeout, 0))
             except asyncio.TimeoutError:
-                log.error("Timeout waiting for bestmove (fen=%s)", fen)
-                self._send("stop")
-                raise
-
+                if time.monotonic() < deadline:
+                    item = None
+                else:
+                    log.error("Timeout waiting for bestmove (fen=%s)", fen)
+                    self._send("stop")
+                    self._end_search()
+                    raise
+            if item is _EXITED:
+                self._end_search()
+                raise EngineCrashed(f"{self.name} exited during a search")
+            line = None
+            if item is not None:
+                last_output, pinged = time.monotonic(), False
+                if item[0] == search:
+                    line = item[1]
+
+            if adaptive is not None and not stopping and not (
+                    line and line.startswith("bestmove")):
+                now = time.monotonic()
+                if now - last_check >= 0.05:
+                    last_check = now
+                    if adaptive.should_stop((now - started) * 1000, latest):
+                        log.debug("%s: adaptive stop after %dms", self.name,
+                                  (now - started) * 1000)
+                        self._send("stop")
+                        stopping = True
+
+            if line is None:
+                continue
             if line.startswith("info"):
-                parts = line.split()
-                # depth and nodes are global (not per-slot)
-                try:
-                    if "depth" in parts:
-                        d = int(parts[parts.index("depth") + 1])
-                        if d > best_depth:
-                            best_depth = d
-                    if "nodes" in parts:
-                        best_nodes = int(parts[parts.index("nodes") + 1])
-                except (ValueError, IndexError):
-                    pass
-                self._parse_info(line, mpv)
+                if timings is not None and not line.startswith("info string"):
+                    now = time.monotonic()
+                    if timings.first_info is None:
+                        timings.first_info = now
+                    depth = info_int(line, " depth ")
+                    if depth is not None:
+                        timings.depths.setdefault(depth, now)
+                if " pv " not in line or line.startswith("info string"):
+                    continue
+                slot = info_int(line, " multipv ") or 1
+                if early is not None and not stopping:
+                    reason = early.reason(slot, line, latest)
+                    if reason is not None:
+                        log.debug("%s: %s, stopping early", self.name, reason)
+                        self._send("stop")
+                        stopping = True
+                latest[slot] = line
+
+                if on_update is not None and 1 in latest:
+                    depth = info_int(line, " depth ") or 0
+                    now   = time.monotonic()
+                    if depth > last_depth or now - last_update >= update_interval:
+                        last_update, last_depth = now, max(depth, last_depth)
+                        on_update(self._materialise(latest))
 
             elif line.startswith("bestmove"):
-                return self._build_result(line, mpv, best_depth, best_nodes)
-
-    def _parse_info(self, line: str, mpv: dict):
-        parts = line.split()
+                self._end_search()
+                if timings is not None:
+                    timings.bestmove = time.monotonic()
+                if adaptive is not None:
+                    adaptive.elapsed_ms = int((time.monotonic() - started) * 1000)
+                parts = line.split()
+                return self._materialise(latest, parts[1] if len(parts) > 1 else None)
 
-        # Which multipv slot? Omitted = slot 1 (when MultiPV=1)
-        slot = 1
-        if "multipv" in parts:
+    async def _settle(self, timeout: float = 5.0):
+        """
+        Before a new position: make sure no earlier search is still running
+        (one abandoned after a timeout), stopping it and waiting for its
+        bestmove, and drop output already read. Kills lc0 and raises
+        EngineCrashed if the bestmove does not come within timeout seconds.
+        """
+        if self._finished < self._started:
+            log.warning("%s: earlier search still running, stopping it", self.name)
+            self._send("stop")
             try:
-                slot = int(parts[parts.index("multipv") + 1])
-            except (ValueError, IndexError):
-                pass
-
-        if slot not in mpv:
-            mpv[slot] = {"score_cp": None, "score_mate": None, "pv": [], "move": None}
-
-        try:
-            if "score" in parts:
-                si   = parts.index("score")
-                kind = parts[si + 1]   # "cp" or "mate"
-                val  = int(parts[si + 2])
-                # lc0 may append "lowerbound"/"upperbound" — safely ignored
-                if kind == "cp":
-                    mpv[slot]["score_cp"]   = val
-                    mpv[slot]["score_mate"] = None
-                elif kind == "mate":
-                    mpv[slot]["score_mate"] = val
-                    mpv[slot]["score_cp"]   = None
-
-            if "pv" in parts:
-                pi             = parts.index("pv")
-                pv             = parts[pi + 1:]
-                mpv[slot]["pv"]   = pv
-                mpv[slot]["move"] = pv[0] if pv else None
+                await asyncio.wait_for(self._await_bestmove(), timeout)
+            except asyncio.TimeoutError:
+                log.error("%s never finished its earlier search, killing it", self.name)
+                self.kill()
+                raise EngineCrashed(f"{self.name} stopped responding") from None
+        while not self._queue.empty():
+            if self._queue.get_nowait() is _EXITED:
+                raise EngineCrashed(f"{self.name} exited")
 
-        except (ValueError, IndexError):
-            pass
+    async def _await_bestmove(self):
+        while self._finished < self._started:
+            if await self._queue.get() is _EXITED:
+                raise EngineCrashed(f"{self.name} exited")
 
-    def _build_result(self, bestmove_line: str, mpv: dict,
-                      depth: int, nodes: int) -> dict:
-        parts    = bestmove_line.split()
-        bestmove = parts[1] if len(parts) > 1 else None
+    def _end_search(self):
+        self._searching = self._pondering = False
+        self._stop_at = self._ponder_started = None
 
+    def ponderhit(self, movetime_ms: int):
+        """
+        The position being pondered has been asked for, with movetime_ms to
+        think. Pondering counts towards that time: lc0 is stopped as soon as
+        it has searched movetime_ms in all, which may be right away.
+        """
+        if not self._searching or self._ponder_started is None:
+            return
+        stop_at = self._ponder_started + movetime_ms / 1000.0
+        if self._pondering:
+            self._pondering = False
+            self._send("ponderhit")
+            self._stop_at = stop_at
+        elif self._stop_at is not None:
+            self._stop_at = max(self._stop_at, stop_at)
+
+    def _materialise(self, latest: dict, bestmove: Optional[str] = None) -> dict:
+        """
+        Parse the newest line of each slot into a result. Without a bestmove
+        (a snapshot mid-search) slot 1's first PV move stands in for it.
+        """
+        mpv: dict[int, dict] = {}    # slot → {score_cp, score_mate, pv, move}
+        depth = nodes = nps = 0
+        for line in latest.values():
+            info = parse_info_line(line)
+            if info is None:
+                continue
+            # depth and nodes are global (not per-slot) and only ever grow;
+            # nps comes from the newest line
+            depth = max(depth, info.depth or 0)
+            if (info.nodes or 0) >= nodes:
+                nodes, nps = info.nodes or 0, info.nps or nps
+            self._parse_info(info, mpv)
+        if bestmove is None:
+            bestmove = mpv.get(1, {}).get("move")
+        return self._build_result(bestmove, mpv, depth, nodes, nps)
+
+    def _parse_info(self, info: InfoLine, mpv: dict):
+        """Fold one parsed info line into its MultiPV slot."""
+        if info.score_kind is None and not info.pv:
+            return
+        slot = mpv.get(info.multipv)
+        if slot is None:
+            slot = mpv[info.multipv] = {"score_cp": None, "score_mate": None,
+                                        "pv": [], "move": None}
+        # lc0 may append "lowerbound"/"upperbound" — safely ignored
+        if info.score_kind == "cp":
+            slot["score_cp"]   = info.score_value
+            slot["score_mate"] = None
+        elif info.score_kind == "mate":
+            slot["score_mate"] = info.score_value
+            slot["score_cp"]   = None
+        if info.pv:
+            slot["pv"]   = info.pv
+            slot["move"] = info.pv[0]
+
+    def _build_result(self, bestmove: Optional[str], mpv: dict,
+                      depth: int, nodes: int, nps: int = 0) -> dict:
         # Guard: "bestmove (none)" means no legal moves (game over)
         if bestmove == "(none)":
             bestmove = None
@@ -230,22 +771,677 @@ class UCIEngine:
             "pv":              slot1.get("pv", []),
             "depth":           depth,
             "nodes":           nodes,
+            "nps":             nps,
             "alternatives":    alternatives,
             "characteristics": calculate_characteristics(mpv),
         }
 
-    async def get_engine_move(self, fen: str, movetime_ms: int = 3000) -> dict:
-        """Best move for the engine to play. Caller MUST hold _engine_lock."""
-        return await self.analyse(fen, movetime_ms)
+    def stop_search(self):
+        """
+        Ask lc0 to finish the running search now. analyse() still returns
+        normally, with whatever lc0 had found when it received "stop".
+        """
+        if self._searching:
+            self._send("stop")
 
-    def stop(self):
+    async def stop(self):
+        self.closing = True
         if self._proc:
             try:
                 self._send("quit")
-                self._proc.wait(timeout=3)
+                await asyncio.wait_for(self._proc.wait(), timeout=3)
             except Exception:
                 self._proc.kill()
-            log.info("lc0 stopped")
+                await self._proc.wait()
+            for task in self._tasks:
+                task.cancel()
+            log.info("%s stopped", self.name)
+
+
+# ── Engine Pool ───────────────────────────────────────────────────────────────
+
+PRIORITY_INTERACTIVE = 0   # engine_move — the user is waiting on the board
+PRIORITY_ANALYSIS    = 1   # analyse — feedback that can arrive a little late
+PRIORITY_BACKGROUND  = 2   # analyse_batch — whole-game review
+PRIORITY_SPECULATIVE = 3   # prefetch / ponder — only worth doing on an idle engine
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "since", "future", "on_preempt")
+
+    def __init__(self, priority: int, seq: int, future: asyncio.Future,
+                 on_preempt: Optional[Callable[[], None]]):
+        self.priority   = priority
+        self.seq        = seq
+        self.since      = time.monotonic()
+        self.future     = future
+        self.on_preempt = on_preempt
+
+
+class EnginePool:
+    """
+    Fixed set of UCIEngine workers. Each lc0 process is single-threaded from
+    the UCI point of view, so a request checks one engine out, runs its
+    search and hands it back.
+
+    When every engine is busy, requests wait in priority order (lowest
+    number first, FIFO within a priority). A waiter that has been passed
+    over for starvation_after seconds is served next regardless of its
+    priority. With preempt=True, a waiting request may also stop a running
+    lower-priority search through the on_preempt callback its owner gave
+    to acquire(). Speculative searches are always preempted for real work,
+    and never count as starved. An engine marked down is handed to nobody
+    until it is marked up again.
+    """
+
+    def __init__(self, engines: list, starvation_after: float = 5.0,
+                 preempt: bool = False):
+        self.engines          = list(engines)
+        self.starvation_after = starvation_after
+        self.preempt          = preempt
+        self._idle:       list = list(self.engines)
+        self._waiters:    list = []
+        self._busy:       dict = {}    # engine → (priority, on_preempt)
+        self._preempting: set  = set()
+        self._down:       set  = set()
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    async def acquire(self, priority: int = PRIORITY_ANALYSIS,
+                      on_preempt: Optional[Callable[[], None]] = None,
+                      prefer: Optional[UCIEngine] = None) -> UCIEngine:
+        """
+        Wait for an idle engine and take it out of the pool. The `prefer`
+        engine is taken if it is idle; otherwise the engine idle longest.
+        """
+        if self._idle and not self._waiters:
+            if prefer in self._idle:
+                self._idle.remove(prefer)
+                engine = prefer
+            else:
+                engine = self._idle.pop(0)
+            self._busy[engine] = (priority, on_preempt)
+            return engine
+
+        self._seq += 1
+        waiter = _Waiter(priority, self._seq,
+                         asyncio.get_running_loop().create_future(), on_preempt)
+        self._waiters.append(waiter)
+        self._preempt_for(priority)
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # Handed an engine just as we gave up — pass it on
+                self.release(waiter.future.result())
+            raise
+
+    def release(self, engine: UCIEngine):
+        """Return an engine previously obtained from acquire()."""
+        self._busy.pop(engine, None)
+        self._preempting.discard(engine)
+        if engine in self._down or not engine.alive:
+            return
+        waiter = self._next_waiter()
+        if waiter is None:
+            self._idle.append(engine)
+            return
+        self._busy[engine] = (waiter.priority, waiter.on_preempt)
+        waiter.future.set_result(engine)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        self._waiters = [w for w in self._waiters if not w.future.done()]
+        if not self._waiters:
+            return None
+        now     = time.monotonic()
+        starved = [w for w in self._waiters if now - w.since >= self.starvation_after
+                   and w.priority < PRIORITY_SPECULATIVE]
+        if starved:
+            waiter = min(starved, key=lambda w: w.seq)
+        else:
+            waiter = min(self._waiters, key=lambda w: (w.priority, w.seq))
+        self._waiters.remove(waiter)
+        return waiter
+
+    def _preempt_for(self, priority: int):
+        """Stop one running search of lower priority than a new waiter."""
+        if self._idle:
+            return
+        victims = [(busy_priority, engine, on_preempt)
+                   for engine, (busy_priority, on_preempt) in self._busy.items()
+                   if busy_priority > priority and on_preempt is not None
+                   and (self.preempt or busy_priority == PRIORITY_SPECULATIVE)
+                   and engine not in self._preempting]
+        if not victims:
+            return
+        victim_priority, engine, on_preempt = max(victims, key=lambda v: v[0])
+        log.log(logging.DEBUG if victim_priority == PRIORITY_SPECULATIVE else logging.INFO,
+                "Preempting %s for a priority %d request", engine.name, priority)
+        self._preempting.add(engine)
+        on_preempt()
+
+    def promote(self, engine: UCIEngine, priority: int):
+        """A running search has become more urgent (a real request now waits on it)."""
+        busy = self._busy.get(engine)
+        if busy is not None and priority < busy[0]:
+            self._busy[engine] = (priority, busy[1])
+
+    def counts(self) -> dict:
+        """Engines by state, and requests waiting for one."""
+        return {"busy": len(self._busy), "idle": len(self._idle),
+                "down": len(self._down), "waiting": len(self._waiters)}
+
+    def mark_down(self, engine: UCIEngine):
+        """Stop handing engine out; a search running on it keeps it until release()."""
+        self._down.add(engine)
+        if engine in self._idle:
+            self._idle.remove(engine)
+
+    def mark_up(self, engine: UCIEngine):
+        """engine is usable again: give it to the next waiter, or make it idle."""
+        self._down.discard(engine)
+        if engine not in self._busy and engine not in self._idle:
+            self.release(engine)
+
+    async def stop(self):
+        await asyncio.gather(*(engine.stop() for engine in self.engines))
+
+
+# ── Engine Supervisor ─────────────────────────────────────────────────────────
+
+class EngineSupervisor:
+    """
+    Restarts pool engines whose lc0 process has exited (crashed, or killed
+    after it stopped responding). The engine is taken out of the pool at
+    once, so requests wait for another engine instead of failing on it, and
+    restarted with the same options. Failed restarts back off exponentially
+    from min_backoff to max_backoff seconds; an engine that has since run
+    for stable_after seconds starts from min_backoff again.
+    """
+
+    def __init__(self, pool: EnginePool, min_backoff: float = 0.25,
+                 max_backoff: float = 30.0, stable_after: float = 60.0):
+        self.pool         = pool
+        self.min_backoff  = min_backoff
+        self.max_backoff  = max_backoff
+        self.stable_after = stable_after
+        self.restarts     = 0
+        self._tasks: list = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._watch(engine))
+                       for engine in self.pool.engines]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _watch(self, engine: UCIEngine):
+        delay   = self.min_backoff
+        up_at   = time.monotonic()
+        while True:
+            await engine.exited.wait()
+            if engine.closing:
+                return
+            self.pool.mark_down(engine)
+            if time.monotonic() - up_at >= self.stable_after:
+                delay = self.min_backoff
+            log.error("%s exited unexpectedly — restarting in %.2fs", engine.name, delay)
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+                try:
+                    started = time.monotonic()
+                    await engine.restart()
+                    break
+                except (OSError, EngineCrashed, asyncio.TimeoutError) as e:
+                    log.error("%s restart failed: %s — retrying in %.2fs",
+                              engine.name, e or type(e).__name__, delay)
+            self.restarts += 1
+            up_at = time.monotonic()
+            log.info("%s restarted in %.2fs (%d restart%s so far)", engine.name,
+                     up_at - started, self.restarts, "" if self.restarts == 1 else "s")
+            self.pool.mark_up(engine)
+
+
+# ── Position Cache ────────────────────────────────────────────────────────────
+
+def normalise_fen(fen: str) -> str:
+    """
+    Drop the halfmove/fullmove counters — they never change lc0's search —
+    and an en passant square no pawn can capture on, which some GUIs write
+    after every double push and others never do. Fields it cannot parse
+    are left as they are; this never raises.
+    """
+    fields = fen.split()[:4]
+    if len(fields) == 4 and fields[3] != "-":
+        try:
+            ep    = _square(fields[3])
+            pawn  = "P" if fields[1] == "w" else "p"
+            board = _parse_board(fields[0])
+            behind = ep - 8 if pawn == "P" else ep + 8
+            if not any(0 <= sq < 64 and abs(sq % 8 - ep % 8) == 1 and board[sq] == pawn
+                       for sq in (behind - 1, behind + 1)):
+                fields[3] = "-"
+        except (ValueError, IndexError):
+            pass
+    return " ".join(fields)
+
+
+class PositionCache:
+    """
+    In-process LRU of finished analyses keyed by (normalised FEN, MultiPV,
+    budget kind).
+
+    The budget's amount acts as a floor: a result from a 3000 ms search also
+    answers a 2000 ms request for the same position (likewise more nodes or
+    a deeper search), but not the other way round. Entries are evicted once
+    there are more than max_entries of them or they are older than max_age
+    seconds.
+    """
+
+    def __init__(self, max_entries: int = 4096, max_age: float = 3600.0):
+        self.max_entries = max_entries
+        self.max_age     = max_age
+        # key → (amount, stored_at, result); most recently used last
+        self._entries: OrderedDict = OrderedDict()
+        self.hits   = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(fen: str, multipv: int = MULTI_PV, kind: str = "movetime") -> tuple:
+        return normalise_fen(fen), multipv, kind
+
+    def get(self, fen: str, budget: SearchBudget,
+            multipv: int = MULTI_PV) -> Optional[dict]:
+        key   = self.key(fen, multipv, budget.cache_kind)
+        entry = self._entries.get(key)
+        if entry is not None:
+            amount, stored_at, result = entry
+            if time.monotonic() - stored_at > self.max_age:
+                del self._entries[key]
+            elif amount >= budget.value:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def put(self, fen: str, budget: SearchBudget, result: dict,
+            multipv: int = MULTI_PV):
+        if self.max_entries <= 0:
+            return
+        key   = self.key(fen, multipv, budget.cache_kind)
+        entry = self._entries.get(key)
+        # Never replace a deeper search with a shallower one
+        if entry is not None and entry[0] > budget.value:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = (budget.value, time.monotonic(), result)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        # Least recently used entries sit at the front; expired entries
+        # further back are dropped lazily in get().
+        now = time.monotonic()
+        while self._entries:
+            key, (_, stored_at, _) = next(iter(self._entries.items()))
+            if now - stored_at <= self.max_age:
+                break
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries":   len(self._entries),
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# ── Persistent Analysis Store ─────────────────────────────────────────────────
+
+def weights_fingerprint(path: Optional[str]) -> str:
+    """
+    Identify a weights file without reading all of it: hash its size plus the
+    first and last MiB. Good enough to tell networks apart, and cheap even
+    for multi-hundred-MB BT4 nets.
+    """
+    if not path or not os.path.isfile(path):
+        return "default"
+    chunk = 1 << 20
+    size  = os.path.getsize(path)
+    h     = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(chunk))
+        if size > chunk:
+            f.seek(max(chunk, size - chunk))
+            h.update(f.read(chunk))
+    return h.hexdigest()[:16]
+
+
+class AnalysisStore:
+    """
+    SQLite file of finished analyses that survives server restarts.
+
+    Rows are keyed by (normalised FEN, MultiPV, weights fingerprint, budget
+    kind, amount). All disk I/O runs on a single worker thread: put() only
+    queues a row, and a background task writes the queue in batches, so
+    the event loop never waits on sqlite.
+    """
+
+    def __init__(self, path: str, weights: str = "default",
+                 batch_size: int = 64, flush_interval: float = 2.0):
+        self.path           = path
+        self.weights        = weights
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        self._db:      Optional[sqlite3.Connection] = None
+        self._pending: list = []
+        self._wakeup   = asyncio.Event()
+        self._task:    Optional[asyncio.Task] = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ── Lifecycle ──────────────────────────────────────────────────────────
+
+    async def open(self):
+        await self._run(self._open)
+        self._task = asyncio.create_task(self._flush_loop())
+        log.info("Analysis store: %s (weights %s)", self.path, self.weights)
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                fen      TEXT    NOT NULL,
+                multipv  INTEGER NOT NULL,
+                weights  TEXT    NOT NULL,
+                budget   TEXT    NOT NULL,
+                amount   INTEGER NOT NULL,
+                result   TEXT    NOT NULL,
+                created  REAL    NOT NULL,
+                PRIMARY KEY (fen, multipv, weights, budget, amount)
+            )""")
+        self._db.commit()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending:
+            batch, self._pending = self._pending, []
+            await self._run(self._write, batch)
+        if self._db:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=True)
+
+    # ── Reads ──────────────────────────────────────────────────────────────
+
+    async def load(self, limit: int, multipv: int = MULTI_PV) -> list:
+        """Most recent `limit` rows for these weights, oldest first."""
+        return await self._run(self._load, limit, multipv)
+
+    def _load(self, limit: int, multipv: int) -> list:
+        rows = self._db.execute(
+            "SELECT fen, budget, amount, result FROM analyses "
+            "WHERE multipv = ? AND weights = ? ORDER BY created DESC LIMIT ?",
+            (multipv, self.weights, limit)).fetchall()
+        return [(fen, SearchBudget(kind, amount), json.loads(result))
+                for fen, kind, amount, result in reversed(rows)]
+
+    async def get(self, fen: str, budget: SearchBudget,
+                  multipv: int = MULTI_PV) -> Optional[tuple]:
+        """Biggest stored search of at least budget → (budget, result)."""
+        return await self._run(self._get, normalise_fen(fen), budget.cache_kind,
+                               budget.value, multipv)
+
+    def _get(self, fen: str, kind: str, amount: int, multipv: int) -> Optional[tuple]:
+        row = self._db.execute(
+            "SELECT amount, result FROM analyses "
+            "WHERE fen = ? AND multipv = ? AND weights = ? AND budget = ? AND amount >= ? "
+            "ORDER BY amount DESC LIMIT 1",
+            (fen, multipv, self.weights, kind, amount)).fetchone()
+        return (SearchBudget(kind, row[0]), json.loads(row[1])) if row else None
+
+    # ── Writes ─────────────────────────────────────────────────────────────
+
+    def put(self, fen: str, budget: SearchBudget, result: dict,
+            multipv: int = MULTI_PV):
+        self._pending.append((normalise_fen(fen), multipv, self.weights,
+                              budget.cache_kind, budget.value, json.dumps(result),
+                              time.time()))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            batch, self._pending = self._pending, []
+            try:
+                await self._run(self._write, batch)
+            except sqlite3.Error:
+                log.exception("Analysis store write failed (%d rows dropped)", len(batch))
+
+    def _write(self, batch: list):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO analyses "
+            "(fen, multipv, weights, budget, amount, result, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        self._db.commit()
+
+
+# ── Opening Book ──────────────────────────────────────────────────────────────
+
+class OpeningBook:
+    """
+    Polyglot .bin opening book. python-chess memory-maps the file, so a
+    lookup is a binary search over pages the OS already has cached.
+
+    lookup() answers in the same shape as UCIEngine.analyse(), with the
+    book's moves as the alternatives (most played first) and no score.
+    """
+
+    def __init__(self, path: str):
+        if chess is None:
+            raise ValueError("The opening book needs python-chess (pip install chess)")
+        self.path    = path
+        self._reader = chess.polyglot.open_reader(path)
+        self.hits    = 0
+
+    def lookup(self, fen: str, pick: bool = False) -> Optional[dict]:
+        """
+        Book result for fen, or None if it is not a book position. With
+        pick=True the bestmove is drawn at random, weighted by how often the
+        book plays each move (for engine_move); otherwise it is the most
+        played one.
+        """
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            return None
+        entries = sorted(self._reader.find_all(board), key=lambda e: e.weight, reverse=True)
+        if not entries:
+            return None
+        self.hits += 1
+        best = self._reader.weighted_choice(board).move if pick else entries[0].move
+        alternatives = []
+        for rank, entry in enumerate(entries[:MULTI_PV], start=1):
+            move = entry.move.uci()
+            from_sq, to_sq, promo = uci_to_parts(move)
+            alternatives.append({
+                "rank": rank, "move": move, "from": from_sq, "to": to_sq,
+                "promotion": promo, "score_cp": None, "score_mate": None,
+            })
+        return {
+            "bestmove":        best.uci(),
+            "score_cp":        None,
+            "score_mate":      None,
+            "pv":              [best.uci()],
+            "depth":           0,
+            "nodes":           0,
+            "alternatives":    alternatives,
+            "characteristics": calculate_characteristics({}),
+            "source":          "book",
+        }
+
+    def close(self):
+        self._reader.close()
+
+
+# ── Endgame Tablebases ────────────────────────────────────────────────────────
+
+TB_WIN_CP = 20000   # score_cp of a tablebase win, less its DTZ
+
+
+class Tablebase:
+    """
+    Syzygy WDL/DTZ tables, memory-mapped by python-chess. Positions with
+    few enough pieces (and no castling rights) are answered exactly, in
+    the shape UCIEngine.analyse() returns, without searching.
+
+    Every legal move is probed and ranked: wins before draws before losses,
+    the quickest win (smallest DTZ) and the slowest loss first. Probes can
+    touch the disk, so they run on a worker thread.
+    """
+
+    def __init__(self, path: str):
+        if chess is None:
+            raise ValueError("Tablebases need python-chess (pip install chess)")
+        self.path = path
+        self._tb  = chess.syzygy.Tablebase()
+        for directory in filter(None, path.split(os.pathsep)):
+            self._tb.add_directory(directory)
+        # Table names are the pieces plus a "v", e.g. KRPvKR
+        self.max_pieces = max((len(name) - 1 for name in self._tb.wdl), default=0)
+        self._executor  = ThreadPoolExecutor(max_workers=1, thread_name_prefix="syzygy")
+        self.hits = 0
+
+    async def probe(self, fen: str) -> Optional[dict]:
+        """Exact result for fen, or None if it is not in the tables."""
+        if self.max_pieces == 0:
+            return None
+        result = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._probe, fen)
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def _probe(self, fen: str) -> Optional[dict]:
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            return None
+        if (chess.popcount(board.occupied) > self.max_pieces or board.castling_rights
+                or board.is_game_over()):
+            return None
+        try:
+            wdl, dtz = self._tb.probe_wdl(board), self._tb.probe_dtz(board)
+            ranked   = self._rank(board)
+            pv       = [ranked[0][0]]
+            line     = board.copy(stack=False)
+            line.push(ranked[0][0])
+            while len(pv) < 5 and not line.is_game_over():
+                move = self._rank(line)[0][0]
+                pv.append(move)
+                line.push(move)
+        except KeyError:    # a table is missing
+            return None
+
+        alternatives = []
+        for rank, (move, move_wdl, move_dtz) in enumerate(ranked[:MULTI_PV], start=1):
+            cp = self._score_cp(move_wdl, move_dtz)
+            from_sq, to_sq, promo = uci_to_parts(move.uci())
+            alternatives.append({
+                "rank": rank, "move": move.uci(), "from": from_sq, "to": to_sq,
+                "promotion": promo, "score_cp": cp, "score_mate": None,
+            })
+        return {
+            "bestmove":        pv[0].uci(),
+            "score_cp":        self._score_cp(wdl, dtz),
+            "score_mate":      None,
+            "pv":              [move.uci() for move in pv],
+            "depth":           0,
+            "nodes":           0,
+            "alternatives":    alternatives,
+            "characteristics": tablebase_characteristics([m[1] for m in ranked]),
+            "source":          "tablebase",
+            "wdl":             wdl,
+            "dtz":             dtz,
+        }
+
+    def _rank(self, board) -> list:
+        """[(move, wdl, dtz)] for every legal move, best first, mover's view."""
+        moves = []
+        for move in board.legal_moves:
+            zeroing = board.is_zeroing(move)
+            board.push(move)
+            if board.is_checkmate():
+                wdl, dtz = 2, 0
+            else:
+                wdl = -self._tb.probe_wdl(board)
+                if wdl == 0:
+                    dtz = 0
+                elif zeroing:
+                    dtz = 1 if wdl > 0 else -1
+                else:
+                    # One ply more than the distance left after the move
+                    after = -self._tb.probe_dtz(board)
+                    dtz   = after + 1 if wdl > 0 else after - 1
+            board.pop()
+            moves.append((move, wdl, dtz))
+        moves.sort(key=lambda m: (-m[1], m[2] if m[1] > 0 else -abs(m[2])))
+        return moves
+
+    @staticmethod
+    def _score_cp(wdl: int, dtz: int) -> int:
+        """Wins and losses as huge scores; a cursed win or blessed loss is a draw."""
+        if wdl == 2:
+            return TB_WIN_CP - abs(dtz)
+        if wdl == -2:
+            return -TB_WIN_CP + abs(dtz)
+        return 0
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._tb.close()
+
+
+def tablebase_feedback(wdl: int, dtz: int, side_to_move: str = "w") -> str:
+    """score_to_feedback() for a tablebase result (WDL from the mover's side)."""
+    mover, other = ("White", "Black") if side_to_move == "w" else ("Black", "White")
+    if wdl == 0:
+        return "Tablebase draw."
+    winner = mover if wdl > 0 else other
+    if abs(wdl) == 1:
+        return f"Tablebase: {winner} wins only without the 50-move rule — a draw."
+    return f"Tablebase win for {winner} (DTZ {abs(dtz)})."
 
 
 # ── Position Characteristics ──────────────────────────────────────────────────
@@ -306,6 +1502,40 @@ def calculate_characteristics(mpv: dict) -> dict:
     }
 
 
+def tablebase_characteristics(wdls: list) -> dict:
+    """
+    calculate_characteristics() for a tablebase position, from the WDL of
+    every legal move (mover's view, best first). DTZ differences are not
+    evaluation gaps: what matters is how many moves keep the best result,
+    with a cursed win or blessed loss counting as the draw it is.
+    """
+    def outcome(wdl: int) -> int:    # win 1, draw 0, loss -1
+        return (wdl > 1) - (wdl < -1)
+
+    best    = outcome(wdls[0])
+    keep    = sum(1 for wdl in wdls if outcome(wdl) == best)
+    result  = {1: "win", 0: "draw", -1: "loss"}[best]
+
+    if keep == len(wdls):
+        sharpness, difficulty, margin, line_type = "Quiet", "Beginner", "Forgiving", "Flexible"
+        explanation = (f"Every move keeps the {result}." if best >= 0
+                       else "Every move loses; the tablebase line resists longest.")
+    elif keep == 1:
+        sharpness, difficulty, margin, line_type = "Sharp", "Advanced", "Narrow", "Forcing"
+        explanation = f"Only one move keeps the {result} — critical position."
+    else:
+        sharpness, difficulty, margin, line_type = ("Tactical", "Intermediate",
+                                                    "Moderate", "Committal")
+        explanation = f"{keep} of {len(wdls)} moves keep the {result}; the others throw it away."
+    return {
+        "sharpness":        sharpness,
+        "difficulty":       difficulty,
+        "margin_for_error": margin,
+        "line_type":        line_type,
+        "explanation":      explanation,
+    }
+
+
 # ── Score Feedback ────────────────────────────────────────────────────────────
 
 def score_to_feedback(score_cp: Optional[int], score_mate: Optional[int],
@@ -351,19 +1581,688 @@ def uci_to_parts(move: str) -> tuple:
     return move[0:2], move[2:4], (move[4] if len(move) > 4 else None)
 
 
+def pgn_positions(pgn: str) -> list:
+    """
+    Every position of a PGN's main line, starting position included, as
+    (fen, (root_fen, moves)) pairs ready for Lc0Server._search().
+    """
+    if chess is None:
+        raise ValueError("PGN input needs python-chess (pip install chess)")
+    game = chess.pgn.read_game(io.StringIO(pgn))
+    if game is None:
+        raise ValueError("Could not parse PGN")
+    board = game.board()
+    root  = board.fen()
+    moves: list = []
+    positions = [(root, None)]
+    for move in game.mainline_moves():
+        board.push(move)
+        moves.append(move.uci())
+        positions.append((board.fen(), (root, list(moves))))
+    return positions
+
+
+def analysis_message(fen: str, result: dict, msg_type: str = "analysis") -> dict:
+    """WebSocket payload for an analysis result (final or partial)."""
+    from_sq, to_sq, promo = uci_to_parts(result["bestmove"] or "")
+    side_to_move = fen.split()[1] if len(fen.split()) > 1 else "w"
+    payload = {
+        "type":            msg_type,
+        "fen":             fen,
+        "bestmove":        result["bestmove"],
+        "from":            from_sq,
+        "to":              to_sq,
+        "promotion":       promo,
+        "score_cp":        result["score_cp"],
+        "score_mate":      result["score_mate"],
+        "pv":              result["pv"][:5],
+        "depth":           result["depth"],
+        "nodes":           result["nodes"],
+        "feedback":        score_to_feedback(
+                               result["score_cp"],
+                               result["score_mate"],
+                               side_to_move),
+        "alternatives":    result.get("alternatives", []),
+        "characteristics": result.get("characteristics"),
+    }
+    if result.get("source"):
+        payload["source"] = result["source"]
+        if result["source"] == "book":
+            payload["feedback"] = "Book position — standard opening theory."
+        elif result["source"] == "tablebase":
+            payload["wdl"] = result["wdl"]
+            payload["dtz"] = result["dtz"]
+            payload["feedback"] = tablebase_feedback(result["wdl"], result["dtz"],
+                                                     side_to_move)
+    return payload
+
+
+# ── Game History ──────────────────────────────────────────────────────────────
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# Rook squares (a1=0 … h8=63) affected by castling, per king destination
+_CASTLE_ROOK = {6: (7, 5), 2: (0, 3), 62: (63, 61), 58: (56, 59)}
+# Castling right lost when a piece moves from / is captured on a square
+_CASTLE_LOSS = {4: "KQ", 7: "K", 0: "Q", 60: "kq", 63: "k", 56: "q"}
+
+
+def _square(name: str) -> int:
+    return (int(name[1]) - 1) * 8 + "abcdefgh".index(name[0])
+
+
+def _square_name(sq: int) -> str:
+    return "abcdefgh"[sq % 8] + str(sq // 8 + 1)
+
+
+def _parse_board(placement: str) -> list:
+    board = [""] * 64
+    for rank, row in enumerate(reversed(placement.split("/"))):
+        file = 0
+        for ch in row:
+            if ch.isdigit():
+                file += int(ch)
+            else:
+                board[rank * 8 + file] = ch
+                file += 1
+    return board
+
+
+def _format_board(board: list) -> str:
+    rows = []
+    for rank in range(7, -1, -1):
+        row, empty = "", 0
+        for piece in board[rank * 8: rank * 8 + 8]:
+            if piece:
+                row  += (str(empty) if empty else "") + piece
+                empty = 0
+            else:
+                empty += 1
+        rows.append(row + (str(empty) if empty else ""))
+    return "/".join(rows)
+
+
+def position_key(fen: str) -> str:
+    """Placement, side to move and castling rights — what identifies a game
+    position regardless of how a client writes en passant or the clocks."""
+    return " ".join(fen.split()[:3])
+
+
+def apply_uci_move(fen: str, move: str) -> str:
+    """
+    FEN after playing a UCI move. Moves are applied, not validated: this is
+    for following a game the client is already playing, not for move
+    generation. Raises ValueError if the from-square is empty.
+    """
+    fields = fen.split()
+    fields += ["w", "-", "-", "0", "1"][len(fields) - 1:]
+    placement, side, castling, ep, halfmove, fullmove = fields[:6]
+    board = _parse_board(placement)
+    src, dst = _square(move[0:2]), _square(move[2:4])
+    piece    = board[src]
+    if not piece:
+        raise ValueError(f"No piece on {move[0:2]} in {fen}")
+    white    = piece.isupper()
+    captured = board[dst]
+    board[src], board[dst] = "", piece
+
+    new_ep = "-"
+    if piece in "Pp":
+        if ep != "-" and dst == _square(ep) and not captured:
+            board[dst - 8 if white else dst + 8] = ""
+        if abs(dst - src) == 16:
+            new_ep = _square_name((src + dst) // 2)
+        if len(move) > 4:
+            board[dst] = move[4].upper() if white else move[4].lower()
+    elif piece in "Kk" and abs(dst - src) == 2 and dst in _CASTLE_ROOK:
+        rook_src, rook_dst = _CASTLE_ROOK[dst]
+        board[rook_dst], board[rook_src] = board[rook_src], ""
+
+    for sq in (src, dst):
+        for right in _CASTLE_LOSS.get(sq, ""):
+            castling = castling.replace(right, "")
+    reset    = piece in "Pp" or bool(captured)
+    halfmove = "0" if reset else str(int(halfmove) + 1)
+    if not white:
+        fullmove = str(int(fullmove) + 1)
+    return " ".join([_format_board(board), "b" if white else "w",
+                     castling or "-", new_ep, halfmove, fullmove])
+
+
+def infer_move(before: str, after: str) -> Optional[str]:
+    """The single UCI move that turns position `before` into `after`, if any."""
+    fields = before.split()
+    fields += ["w", "-", "-", "0", "1"][len(fields) - 1:]
+    a = _parse_board(fields[0])
+    b = _parse_board(after.split()[0])
+    changed = [sq for sq in range(64) if a[sq] != b[sq]]
+    if not changed or len(changed) > 4:
+        return None
+    white = fields[1] == "w"
+    mine  = str.isupper if white else str.islower
+    sources = [sq for sq in changed if a[sq] and mine(a[sq])]
+    targets = [sq for sq in changed if b[sq] and mine(b[sq])]
+    target_key = position_key(after)
+    for src in sources:
+        for dst in targets:
+            move = _square_name(src) + _square_name(dst)
+            if a[src] in "Pp" and b[dst] not in "Pp":
+                move += b[dst].lower()
+            try:
+                if position_key(apply_uci_move(before, move)) == target_key:
+                    return move
+            except (ValueError, IndexError):
+                continue
+    return None
+
+
+class GameHistory:
+    """
+    The game a client is playing, as a root FEN plus UCI moves.
+
+    Clients only ever send FENs. Each new FEN is matched against the game so
+    far — the same position, an earlier one (takeback), or one or two plies
+    further on, repetitions included — so the engine can be sent "position … moves …" and reuse
+    its search tree. Anything unrecognised starts a new game.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.root:  Optional[str] = None
+        self.moves: list = []
+        self._keys: list = []     # position_key after each prefix of moves
+        self._fens: list = []     # FEN after each prefix of moves
+        self._hints: list = []    # likely next moves from the last search
+
+    def advance(self, fen: str) -> tuple:
+        """
+        Place fen in the game; returns (root_fen, moves) to send lc0. A FEN
+        the move helpers cannot make sense of starts a new game.
+        """
+        key = position_key(fen)
+        if self.root is not None:
+            ply = self._latest(key)
+            if ply == len(self.moves):       # the current position
+                return self.root, list(self.moves)
+            path = None
+            # A position seen before is a takeback unless the clocks say the
+            # game moved on to it — a repetition, which lc0 must see played.
+            if ply is None or fen.split()[4:6] not in ([], self._fens[ply].split()[4:6]):
+                try:
+                    current = self._fens[-1]
+                    path    = self._bridge(current, fen)
+                    fens    = []
+                    for move in path or ():
+                        current = apply_uci_move(current, move)
+                        fens.append(current)
+                except (ValueError, IndexError, KeyError):
+                    path = None
+            if path is not None:
+                self.moves += path
+                self._fens += fens
+                self._keys += [position_key(f) for f in fens]
+                self._hints = []
+                return self.root, list(self.moves)
+            if ply is not None:              # takeback
+                del self.moves[ply:]
+                del self._keys[ply + 1:]
+                del self._fens[ply + 1:]
+                self._hints = []
+                return self.root, list(self.moves)
+        self.root, self.moves, self._hints = fen, [], []
+        self._keys, self._fens = [key], [fen]
+        return self.root, []
+
+    def line(self, fen: str, *moves: str) -> Optional[tuple]:
+        """(root_fen, moves) for fen plus moves, if fen is where the game is now."""
+        if not self._keys or position_key(fen) != self._keys[-1]:
+            return None
+        return self.root, self.moves + list(moves)
+
+    def note_result(self, fen: str, result: dict):
+        """Remember the engine's candidate moves as hints for two-ply jumps."""
+        if self._keys and position_key(fen) == self._keys[-1]:
+            self._hints = [alt["move"] for alt in result.get("alternatives", [])]
+
+    def _latest(self, key: str) -> Optional[int]:
+        """Ply of the latest occurrence of key in the game, or None."""
+        for ply in range(len(self._keys) - 1, -1, -1):
+            if self._keys[ply] == key:
+                return ply
+        return None
+
+    def _bridge(self, current: str, fen: str) -> Optional[list]:
+        move = infer_move(current, fen)
+        if move is not None:
+            return [move]
+        for first in self._hints:
+            try:
+                middle = apply_uci_move(current, first)
+            except (ValueError, IndexError):
+                continue
+            second = infer_move(middle, fen)
+            if second is not None:
+                return [first, second]
+        return None
+
+
+def fen_list_positions(fens: list) -> list:
+    """
+    (fen, history) pairs for analyse_batch. Runs of FENs that follow one
+    another by a single move share a root, so lc0 can reuse its tree.
+    """
+    positions: list = []
+    root, moves, prev = None, [], None
+    for fen in fens:
+        move = infer_move(prev, fen) if prev else None
+        if move is None:
+            root, moves = fen, []
+        else:
+            moves = moves + [move]
+        positions.append((fen, (root, moves) if moves else None))
+        prev = fen
+    return positions
+
+
+# ── Client Requests ───────────────────────────────────────────────────────────
+
+class SearchCancelled(Exception):
+    """The request was cancelled before an engine started searching for it."""
+
+
+class EngineAffinity:
+    """
+    The engine a client (or one run of a batch) last searched on. Going back
+    to it keeps lc0's tree and NN cache for that game warm.
+    """
+    __slots__ = ("engine",)
+
+    def __init__(self):
+        self.engine: Optional[UCIEngine] = None
+
+
+class RequestTimings:
+    """
+    When one request reached each stage, for clients that ask for a
+    "timings" object: monotonic times, reported as ms since receipt.
+    """
+    __slots__ = ("received", "enqueued", "acquired", "first_info", "bestmove", "depths")
+
+    def __init__(self):
+        self.received   = time.monotonic()
+        self.enqueued:   Optional[float] = None   # started waiting for an engine
+        self.acquired:   Optional[float] = None   # got one
+        self.first_info: Optional[float] = None   # lc0's first info line
+        self.bestmove:   Optional[float] = None
+        self.depths: dict = {}                    # depth → when lc0 first reached it
+
+    def as_dict(self, result: dict) -> dict:
+        """The reply's "timings"; stages the request skipped are null."""
+        def ms(t):
+            return None if t is None else round((t - self.received) * 1000, 1)
+        return {
+            "enqueued_ms":   ms(self.enqueued),
+            "acquired_ms":   ms(self.acquired),
+            "first_info_ms": ms(self.first_info),
+            "bestmove_ms":   ms(self.bestmove),
+            "sent_ms":       ms(time.monotonic()),
+            "nps":           result.get("nps"),
+            "time_to_depth": {str(d): ms(t) for d, t in sorted(self.depths.items())},
+        }
+
+
+class SearchHandle:
+    """
+    One client request's claim on the engine pool.
+
+    cancel() works at every stage: while the request waits for an engine it
+    abandons the wait, and once a search is running it sends UCI "stop" so
+    the engine returns its partial result straight away. preempt() is the
+    pool's way of doing the same to make room for a more urgent request.
+    """
+
+    def __init__(self, cmd: str, request_id=None,
+                 priority: int = PRIORITY_ANALYSIS,
+                 affinity: Optional[EngineAffinity] = None):
+        self.cmd        = cmd
+        self.request_id = request_id
+        self.priority   = priority
+        self.affinity   = affinity
+        self.engine:    Optional[UCIEngine] = None
+        self.timings:   Optional[RequestTimings] = None
+        self.search:    Optional[tuple] = None   # (normalised FEN, SearchBudget, adaptive)
+        self.started:   Optional[float] = None   # monotonic time an engine was checked out
+        self.cancelled  = False
+        self.preempted  = False
+        self._waiter:   Optional[asyncio.Future] = None
+
+    def covers(self, fen: str, budget: SearchBudget, adaptive: bool) -> bool:
+        """True if this request is the same search a new request asks for."""
+        if self.search is None or self.cancelled:
+            return False
+        return self.search == (normalise_fen(fen), budget, adaptive)
+
+    @property
+    def stopped_early(self) -> bool:
+        """True if the result is partial and must not be cached."""
+        return self.cancelled or self.preempted
+
+    async def acquire(self, pool: EnginePool) -> UCIEngine:
+        """Check an engine out of pool for this request."""
+        if self.cancelled:
+            raise SearchCancelled()
+        prefer       = self.affinity.engine if self.affinity else None
+        self._waiter = asyncio.ensure_future(pool.acquire(self.priority, self.preempt, prefer))
+        try:
+            engine = await self._waiter
+        except asyncio.CancelledError:
+            # The wait may have finished just as we were cancelled
+            if self._waiter.done() and not self._waiter.cancelled():
+                pool.release(self._waiter.result())
+            if self.cancelled and not asyncio.current_task().cancelling():
+                raise SearchCancelled() from None
+            raise
+        finally:
+            self._waiter = None
+        if self.cancelled:
+            pool.release(engine)
+            raise SearchCancelled()
+        self.engine  = engine
+        self.started = time.monotonic()
+        if self.affinity is not None:
+            if prefer is not None and engine is not prefer:
+                log.debug("%s busy, %s searching instead", prefer.name, engine.name)
+            self.affinity.engine = engine
+        return engine
+
+    async def follow(self, shared: "_InFlight") -> Optional[dict]:
+        """Wait for another request's identical search instead of running one."""
+        if self.cancelled:
+            raise SearchCancelled()
+        shared.followers += 1
+        self._waiter = asyncio.shield(shared.future)
+        try:
+            return await self._waiter
+        except asyncio.CancelledError:
+            if self.cancelled and not asyncio.current_task().cancelling():
+                raise SearchCancelled() from None
+            raise
+        finally:
+            self._waiter = None
+
+    def release(self, pool: EnginePool):
+        engine, self.engine = self.engine, None
+        if engine is not None:
+            pool.release(engine)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.engine is not None:
+            self.engine.stop_search()
+        elif self._waiter is not None:
+            self._waiter.cancel()
+
+    def preempt(self):
+        if self.engine is not None:
+            self.preempted = True
+            self.engine.stop_search()
+
+
+class _InFlight:
+    """A running search that identical requests wait on instead of repeating."""
+    __slots__ = ("amount", "span_ms", "policy_ms", "leader", "future", "followers")
+
+    def __init__(self, amount: int, leader: SearchHandle, span_ms: Optional[int],
+                 policy_ms: Optional[int] = None):
+        self.amount    = amount      # in units of the search's budget kind
+        self.span_ms   = span_ms     # longest it runs once started; None: until a ponderhit
+        self.policy_ms = policy_ms   # movetime_ms of an adaptive leader's policy
+        self.leader    = leader
+        self.future    = asyncio.get_running_loop().create_future()
+        self.followers = 0
+
+    def serves(self, budget: SearchBudget, handle: SearchHandle,
+               adaptive: Optional[AdaptiveTime] = None) -> bool:
+        """
+        True if the result will be good enough for budget (or, for an
+        adaptive request, comes from a policy at least as generous), it will
+        be ready within the time the request would have searched itself —
+        always so for an identical search — and waiting for it will not
+        leave handle queued behind a less urgent request.
+        """
+        if adaptive is not None and self.policy_ms is not None:
+            enough = self.policy_ms >= adaptive.movetime_ms
+            same   = self.policy_ms == adaptive.movetime_ms
+        else:
+            enough = self.amount >= budget.value
+            same   = self.amount == budget.value and self.policy_ms is None
+        if same or budget.cache_kind != "movetime":
+            in_time = same
+        elif self.span_ms is None:       # a ponderhit stops it within the joiner's time
+            in_time = True
+        else:
+            wait_ms = adaptive.max_ms if adaptive else budget.value
+            started = self.leader.started
+            in_time = (started is not None and
+                       started + self.span_ms / 1000.0 <= time.monotonic() + wait_ms / 1000.0)
+        return enough and in_time and (
+            self.leader.engine is not None or self.leader.priority <= handle.priority)
+
+    def finish(self, result: Optional[dict] = None, error: Optional[Exception] = None):
+        """Hand followers the result; None tells them to search themselves."""
+        if self.future.done():
+            return
+        if error is not None and self.followers:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+
+
+class BatchHandle(SearchHandle):
+    """
+    SearchHandle for analyse_batch: every position gets its own child
+    handle (so the pool can preempt them one at a time), and cancelling
+    the batch cancels whichever children are queued or running.
+    """
+
+    def __init__(self, request_id=None):
+        super().__init__("analyse_batch", request_id, PRIORITY_BACKGROUND)
+        self.children: set = set()
+
+    def child(self, affinity: Optional[EngineAffinity] = None) -> SearchHandle:
+        handle = SearchHandle(self.cmd, self.request_id, self.priority, affinity)
+        self.children.add(handle)
+        return handle
+
+    def cancel(self):
+        self.cancelled = True
+        for handle in list(self.children):
+            handle.cancel()
+
+
+class ClientSession:
+    """Per-WebSocket state: the connection, its tasks and in-flight searches."""
+
+    def __init__(self, ws):
+        self.ws       = ws
+        self.game     = GameHistory()
+        self.affinity = EngineAffinity()
+        self.searches: dict = {}     # request key → SearchHandle
+        self.speculation: dict = {}  # prefetch/ponder SearchHandle → normalised FEN
+        self.budgets:  dict = {}     # last SearchBudget per command, for prefetching
+        self._tasks:   set  = set()
+        self._next_id  = 0
+
+    async def send(self, payload: dict, request_id=None):
+        if request_id is not None:
+            payload["id"] = request_id
+        await self.ws.send(json.dumps(payload))
+
+    def spawn(self, coro):
+        """Run one request concurrently with the rest of the connection."""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None and not isinstance(exc, websockets.exceptions.ConnectionClosed):
+            log.error("Request failed", exc_info=exc)
+
+    def register(self, cmd: str, request_id=None) -> tuple:
+        """Track a new search; returns (key, handle)."""
+        if request_id is not None:
+            key = str(request_id)
+        else:
+            self._next_id += 1
+            key = f"#{self._next_id}"
+        if cmd == "analyse_batch":
+            handle = BatchHandle(request_id)
+        elif cmd in ("prefetch", "ponder"):
+            # Pondering stays on this client's engine, where lc0 has the game's
+            # tree; prefetches take whichever engine is free.
+            handle = SearchHandle(cmd, request_id, PRIORITY_SPECULATIVE,
+                                  self.affinity if cmd == "ponder" else None)
+        else:
+            priority = PRIORITY_INTERACTIVE if cmd == "engine_move" else PRIORITY_ANALYSIS
+            handle   = SearchHandle(cmd, request_id, priority, self.affinity)
+        self.searches[key] = handle
+        return key, handle
+
+    def unregister(self, key: str, handle: SearchHandle):
+        if self.searches.get(key) is handle:
+            del self.searches[key]
+
+    def cancel_speculation(self, keep_fen: Optional[str] = None):
+        """Drop prefetch/ponder searches, except one for keep_fen."""
+        keep = normalise_fen(keep_fen) if keep_fen else None
+        for handle, fen in list(self.speculation.items()):
+            if fen != keep:
+                handle.cancel()
+
+    def cancel_all(self, cmds: Optional[tuple] = None, keep: Optional[tuple] = None):
+        """Cancel searches (of cmds), except any that covers keep (fen, budget, adaptive)."""
+        for handle in list(self.searches.values()):
+            if cmds is None or handle.cmd in cmds:
+                if keep is not None and handle.covers(*keep):
+                    continue
+                handle.cancel()
+
+
+# ── Metrics ───────────────────────────────────────────────────────────────────
+
+class Histogram:
+    """Cumulative-bucket latency histogram, in seconds (Prometheus style)."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count  = 0
+        self.sum    = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum   += seconds
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+
+    def render(self, name: str, labels: str) -> list:
+        lines = [f'{name}_bucket{{{labels},le="{bound}"}} {n}'
+                 for bound, n in zip(self.BUCKETS, self.counts)]
+        lines += [f'{name}_bucket{{{labels},le="+Inf"}} {self.count}',
+                  f"{name}_sum{{{labels}}} {self.sum:.6f}",
+                  f"{name}_count{{{labels}}} {self.count}"]
+        return lines
+
+
+class Metrics:
+    """
+    Counters for every search the server runs, by command: time spent
+    waiting for an engine, time lc0 spent searching, nodes searched, and
+    timeouts. Gauges (cache, clients, engines) are read from the server
+    when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self.queue_wait: dict = {}   # cmd → Histogram
+        self.search:     dict = {}   # cmd → Histogram
+        self.nodes       = 0
+        self.timeouts    = 0
+        self.nps:        dict = {}   # engine name → nps of its last search
+
+    def observe(self, cmd: str, engine: UCIEngine, wait_s: float, search_s: float,
+                result: dict):
+        self.queue_wait.setdefault(cmd, Histogram()).observe(wait_s)
+        self.search.setdefault(cmd, Histogram()).observe(search_s)
+        self.nodes += result.get("nodes") or 0
+        if result.get("nps"):
+            self.nps[engine.name] = result["nps"]
+
+    def render(self, gauges: dict) -> str:
+        """Prometheus text exposition: these counters plus gauges (name → value)."""
+        out = []
+        for name, help_text, table in (
+                ("lc0_bridge_queue_wait_seconds", "Time a search waited for an engine.",
+                 self.queue_wait),
+                ("lc0_bridge_search_seconds", "Time lc0 spent on a search.", self.search)):
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for cmd, hist in sorted(table.items()):
+                out += hist.render(name, f'cmd="{cmd}"')
+        out += ["# TYPE lc0_bridge_nodes_total counter",
+                f"lc0_bridge_nodes_total {self.nodes}",
+                "# TYPE lc0_bridge_timeouts_total counter",
+                f"lc0_bridge_timeouts_total {self.timeouts}",
+                "# HELP lc0_bridge_nps Nodes per second lc0 reported for its last search.",
+                "# TYPE lc0_bridge_nps gauge"]
+        out += [f'lc0_bridge_nps{{engine="{name}"}} {nps}'
+                for name, nps in sorted(self.nps.items())]
+        for name, value in gauges.items():
+            kind = "counter" if name.endswith("_total") else "gauge"
+            out += [f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(out) + "\n"
+
+
 # ── WebSocket Server ──────────────────────────────────────────────────────────
 
 class Lc0Server:
-    def __init__(self, engine: UCIEngine, host: str = "0.0.0.0", port: int = 8765):
-        self.engine = engine
-        self.host   = host
-        self.port   = port
+    def __init__(self, pool: EnginePool, host: str = "0.0.0.0", port: int = 8765,
+                 cache: Optional[PositionCache] = None,
+                 store: Optional[AnalysisStore] = None,
+                 adaptive: bool = False, max_search_ms: int = 30000,
+                 book: Optional[OpeningBook] = None, book_analyse: bool = False,
+                 tablebase: Optional[Tablebase] = None,
+                 prefetch: int = 0, ponder: bool = False,
+                 supervisor: Optional[EngineSupervisor] = None,
+                 metrics_port: int = 0):
+        self.pool     = pool
+        self.host     = host
+        self.port     = port
+        self.cache    = cache if cache is not None else PositionCache()
+        self.store    = store
+        self.adaptive = adaptive     # default for requests that don't say
+        self.max_search_ms = max_search_ms   # deadline for nodes/depth budgets
+        self.book          = book
+        self.book_analyse  = book_analyse    # book answers analyse too, not just engine_move
+        self.tablebase     = tablebase
+        self.prefetch      = prefetch        # reply positions searched ahead
+        self.ponder        = ponder
+        self.supervisor    = supervisor
+        self._inflight: dict = {}            # cache key → _InFlight
+        self.coalesced     = 0               # requests answered by another's search
+        self.metrics       = Metrics()
+        self.metrics_port  = metrics_port    # HTTP port for /metrics (0 = none)
         self._clients: set = set()
-        # Single lock — lc0 is single-threaded; never run two searches at once.
-        self._engine_lock = asyncio.Lock()
 
     async def handle(self, ws):
         self._clients.add(ws)
+        session = ClientSession(ws)
         log.info("Client connected: %s", ws.remote_address)
         try:
             async for raw in ws:
@@ -372,75 +2271,482 @@ class Lc0Server:
                 except json.JSONDecodeError:
                     await ws.send(json.dumps({"type": "error", "message": "Invalid JSON"}))
                     continue
-                await self._dispatch(ws, msg)
+                # Requests run concurrently so "cancel" can reach a running search
+                session.spawn(self._dispatch(session, msg))
         except websockets.exceptions.ConnectionClosed:
             log.info("Client disconnected: %s", ws.remote_address)
         finally:
             self._clients.discard(ws)
+            # Nobody is left to read the results — free the engines
+            session.cancel_all()
+
+    async def _search(self, fen: str, budget: SearchBudget,
+                      handle: Optional[SearchHandle] = None,
+                      on_update: Optional[Callable[[dict], None]] = None,
+                      update_interval: float = 0.1,
+                      history: Optional[tuple] = None,
+                      adaptive: Optional[AdaptiveTime] = None,
+                      ponder: bool = False) -> dict:
+        """
+        Answer from the endgame tablebases, the position cache, then the
+        on-disk store, then a search already running for the same position,
+        and only then run a search on an idle engine. Results of cancelled
+        or preempted searches are partial and are neither cached nor shared.
+
+        history, if given, is (root_fen, moves) leading to fen; the engine
+        is then sent the moves rather than the bare FEN.
+
+        An adaptive search is cached under the time it actually took, and is
+        answered only by an earlier search of at least the policy's
+        movetime_ms (or joins a running adaptive search with at least that
+        movetime). A nodes or depth search that ran into its deadline first
+        is not cached.
+
+        ponder=True (movetime budgets only) searches with "go ponder" until a
+        request for budget joins it, or --max-search-ms passes.
+        """
+        if self.tablebase is not None:
+            result = await self.tablebase.probe(fen)
+            if result is not None:
+                log.debug("Tablebase hit: %s", fen)
+                return result
+        lookup = SearchBudget("movetime", adaptive.movetime_ms) if adaptive else budget
+        result = self.cache.get(fen, lookup)
+        if result is not None:
+            log.debug("Cache hit: %s (%s)", fen, lookup)
+            return result
+        if self.store:
+            stored = await self.store.get(fen, lookup)
+            if stored is not None:
+                log.debug("Store hit: %s (%s)", fen, lookup)
+                self.cache.put(fen, stored[0], stored[1])
+                return stored[1]
+
+        handle = handle or SearchHandle("internal")
+        key    = PositionCache.key(fen, MULTI_PV, lookup.cache_kind)
+        shared = self._inflight.get(key)
+        # Streaming requests want their own partial results, so never wait
+        if on_update is None and shared is not None and shared.serves(lookup, handle, adaptive):
+            log.debug("Joining in-flight search: %s (%s)", fen, lookup)
+            leader = shared.leader
+            if leader.engine is not None:
+                if leader.cmd == "ponder" and budget.kind == "movetime":
+                    # The joiner's whole movetime, not just its adaptive lookup
+                    leader.engine.ponderhit(adaptive.movetime_ms if adaptive
+                                            else budget.value)
+                self.pool.promote(leader.engine, handle.priority)
+            leader.priority = min(leader.priority, handle.priority)
+            result = await handle.follow(shared)
+            if result is not None:
+                self.coalesced += 1
+                return result
+        if key in self._inflight:
+            return await self._run_search(fen, budget, handle, on_update,
+                                          update_interval, history, adaptive, ponder)
+
+        # A ponder search runs on until whoever joins it has had their time;
+        # an adaptive one is only sure to run for its policy's min_ms
+        if ponder:
+            shared = _InFlight(self.max_search_ms, handle, None)
+        elif adaptive:
+            shared = _InFlight(adaptive.min_ms, handle, adaptive.max_ms, adaptive.movetime_ms)
+        else:
+            shared = _InFlight(lookup.value, handle, lookup.value)
+        self._inflight[key] = shared
+        try:
+            result = await self._run_search(fen, budget, handle, on_update,
+                                            update_interval, history, adaptive, ponder)
+        except (SearchCancelled, asyncio.CancelledError):
+            shared.finish()
+            raise
+        except Exception as e:
+            shared.finish(error=e)
+            raise
+        finally:
+            if self._inflight.get(key) is shared:
+                del self._inflight[key]
+        shared.finish(None if handle.stopped_early else result)
+        return result
+
+    async def _run_search(self, fen: str, budget: SearchBudget, handle: SearchHandle,
+                          on_update: Optional[Callable[[dict], None]],
+                          update_interval: float, history: Optional[tuple],
+                          adaptive: Optional[AdaptiveTime], ponder: bool = False) -> dict:
+        """The engine part of _search(): check an engine out, search, cache."""
+        enqueued = time.monotonic()
+        engine   = await handle.acquire(self.pool)
+        try:
+            root, moves = history or (fen, None)
+            started = time.monotonic()
+            if handle.timings is not None:
+                handle.timings.enqueued, handle.timings.acquired = enqueued, started
+            result  = await engine.analyse(
+                root, on_update=on_update, update_interval=update_interval, moves=moves,
+                adaptive=adaptive, ponder=ponder, timings=handle.timings,
+                budget=SearchBudget("infinite", self.max_search_ms) if ponder else budget)
+            elapsed_ms = int((time.monotonic() - started) * 1000)
+        except asyncio.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            handle.release(self.pool)
+        self.metrics.observe(handle.cmd, engine, started - enqueued,
+                             elapsed_ms / 1000.0, result)
+        if handle.stopped_early:
+            return result
+        if adaptive is not None:
+            budget = SearchBudget("movetime", adaptive.elapsed_ms)
+        elif ponder:
+            budget = SearchBudget("movetime", elapsed_ms)
+        elif budget.kind in ("nodes", "depth") and result[budget.kind] < budget.value:
+            log.debug("Deadline before %s: %s", budget, fen)
+            return result
+        self.cache.put(fen, budget, result)
+        if self.store:
+            self.store.put(fen, budget, result)
+        return result
+
+    async def _speculate(self, session: ClientSession, fen: str, result: dict):
+        """
+        After an engine_move: search the position the engine's move leads to
+        (the client usually asks to analyse it next and joins that search),
+        then, while the player thinks, search the positions after their
+        likeliest replies with the client's engine_move budget, so the next
+        request is often a cache hit. With --ponder the likeliest reply is
+        pondered on the client's own engine instead.
+        """
+        try:
+            after = apply_uci_move(fen, result["bestmove"])
+        except (TypeError, ValueError, IndexError):
+            return
+        history        = session.game.line(fen, result["bestmove"])
+        analyse_budget = session.budgets.get("analyse", SearchBudget("movetime", 2000))
+        move_budget    = session.budgets.get("engine_move", SearchBudget("movetime", 3000))
+        reply = await self._speculative_search(session, "prefetch", after,
+                                               analyse_budget, history)
+        if reply is None:
+            return
+        ponder   = self.ponder and move_budget.kind == "movetime"
+        searches = []
+        for i, alt in enumerate(reply.get("alternatives", [])[:max(self.prefetch, ponder)]):
+            try:
+                child = apply_uci_move(after, alt["move"])
+            except (ValueError, IndexError):
+                continue
+            line = (history[0], history[1] + [alt["move"]]) if history else None
+            searches.append(self._speculative_search(
+                session, "ponder" if ponder and i == 0 else "prefetch",
+                child, move_budget, line))
+        await asyncio.gather(*searches)
+
+    async def _speculative_search(self, session: ClientSession, cmd: str, fen: str,
+                                  budget: SearchBudget,
+                                  history: Optional[tuple]) -> Optional[dict]:
+        """One prefetch or ponder search; None if real work cut it short."""
+        key, handle = session.register(cmd)
+        session.speculation[handle] = normalise_fen(fen)
+        try:
+            result = await self._search(fen, budget, handle, history=history,
+                                        ponder=cmd == "ponder")
+            return None if handle.stopped_early else result
+        except (SearchCancelled, EngineCrashed, asyncio.TimeoutError):
+            return None
+        finally:
+            session.speculation.pop(handle, None)
+            session.unregister(key, handle)
+
+    def _budget(self, msg: dict, movetime_ms: int) -> SearchBudget:
+        """
+        A request's search budget: "nodes", "depth" or "infinite" with a
+        "deadline" (ms), else "movetime" (movetime_ms if the request has
+        none). Raises ValueError for a budget that makes no sense.
+        """
+        deadline = int(msg.get("deadline", self.max_search_ms))
+        if msg.get("nodes") is not None:
+            budget = SearchBudget("nodes", int(msg["nodes"]), deadline)
+        elif msg.get("depth") is not None:
+            budget = SearchBudget("depth", int(msg["depth"]), deadline)
+        elif msg.get("infinite"):
+            budget = SearchBudget("infinite", deadline)
+        else:
+            budget = SearchBudget("movetime", int(msg.get("movetime", movetime_ms)))
+        if budget.value <= 0 or deadline <= 0:
+            raise ValueError(f"Invalid search budget: {budget}")
+        return budget
+
+    def _book_lookup(self, msg: dict, fen: str, default: bool,
+                     pick: bool = False) -> Optional[dict]:
+        """
+        The opening book's answer, if the server has a book and the request
+        wants it ("book": true/false, else default).
+        """
+        if self.book is None or not msg.get("book", default):
+            return None
+        result = self.book.lookup(fen, pick)
+        if result is not None:
+            log.debug("Book hit: %s", fen)
+        return result
+
+    def _time_policy(self, msg: dict, budget: SearchBudget) -> Optional[AdaptiveTime]:
+        """
+        AdaptiveTime for a movetime request with "adaptive": true (or any
+        movetime request when the server runs with --adaptive);
+        "max_movetime" caps it. Raises ValueError for a cap that makes no sense.
+        """
+        if budget.kind != "movetime" or not msg.get("adaptive", self.adaptive):
+            return None
+        cap = msg.get("max_movetime")
+        if cap is not None:
+            try:
+                cap = int(cap)
+            except (TypeError, ValueError):
+                cap = 0
+            if cap <= 0:
+                raise ValueError(f"Invalid max_movetime: {msg['max_movetime']!r}")
+        return AdaptiveTime(budget.value, cap)
+
+    async def _search_streaming(self, session: ClientSession, handle: SearchHandle,
+                                fen: str, budget: SearchBudget, interval: float,
+                                history: Optional[tuple] = None,
+                                adaptive: Optional[AdaptiveTime] = None) -> dict:
+        """
+        _search() that forwards partial results as "analysis_partial"
+        messages. Snapshots are conflated: if the client is slower than the
+        engine, only the newest one waiting to be sent survives.
+        """
+        pending: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+        def offer(item):
+            if pending.full():
+                pending.get_nowait()
+            pending.put_nowait(item)
+
+        async def pump():
+            while (snapshot := await pending.get()) is not None:
+                await session.send(analysis_message(fen, snapshot, "analysis_partial"),
+                                   handle.request_id)
+
+        sender = asyncio.create_task(pump())
+        try:
+            return await self._search(fen, budget, handle, offer, interval,
+                                      history, adaptive)
+        finally:
+            offer(None)
+            await sender
+
+    async def _search_batch_position(self, handle: BatchHandle, affinity: EngineAffinity,
+                                     fen: str, budget: SearchBudget,
+                                     history: Optional[tuple]) -> dict:
+        """One batch position; a preempted search is simply run again."""
+        while True:
+            child = handle.child(affinity)
+            try:
+                result = await self._search(fen, budget, child, history=history)
+            finally:
+                handle.children.discard(child)
+            if handle.cancelled:
+                raise SearchCancelled()
+            if not child.preempted:
+                return result
+
+    async def _analyse_batch(self, session: ClientSession, handle: BatchHandle,
+                             positions: list, budget: SearchBudget) -> int:
+        """
+        Analyse a list of (fen, history) positions and send one
+        "batch_analysis" message per position, in order. The list is split
+        into one contiguous run per engine so consecutive plies of a game
+        reach the same lc0 process and can reuse its tree. Returns the
+        number of positions sent.
+        """
+        loop    = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in positions]
+
+        async def work(first: int, last: int):
+            affinity = EngineAffinity()
+            for i in range(first, last):
+                if handle.cancelled:
+                    futures[i].set_result(None)
+                    continue
+                fen, history = positions[i]
+                try:
+                    futures[i].set_result(await self._search_batch_position(
+                        handle, affinity, fen, budget, history))
+                except SearchCancelled:
+                    futures[i].set_result(None)
+                except Exception as e:
+                    futures[i].set_result(e)
+
+        runs    = max(1, min(len(self.pool), len(positions)))
+        size    = -(-len(positions) // runs)
+        workers = [asyncio.create_task(work(i, min(i + size, len(positions))))
+                   for i in range(0, len(positions), size)]
+        sent = 0
+        try:
+            for i, future in enumerate(futures):
+                item = await future
+                if item is None:
+                    break
+                fen = positions[i][0]
+                if isinstance(item, asyncio.TimeoutError):
+                    payload = {"type": "error", "message": "Engine timeout"}
+                elif isinstance(item, Exception):
+                    payload = {"type": "error", "message": str(item)}
+                else:
+                    payload = analysis_message(fen, item, "batch_analysis")
+                payload["index"] = i
+                await session.send(payload, handle.request_id)
+                sent += 1
+        finally:
+            if sent < len(positions):
+                handle.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return sent
+
+    async def _dispatch(self, session: ClientSession, msg: dict):
+        cmd        = msg.get("cmd", "")
+        request_id = msg.get("id")
+        timings    = RequestTimings() if msg.get("timings") else None
 
-    async def _dispatch(self, ws, msg: dict):
-        cmd = msg.get("cmd", "")
+        async def reply(payload: dict):
+            await session.send(payload, request_id)
 
         if cmd == "ping":
-            await ws.send(json.dumps({"type": "pong"}))
+            await reply({"type": "pong"})
 
         elif cmd == "new_game":
-            # Clears lc0 hash — safe to call without holding the lock
-            # since new_game is fired between searches, never during one.
-            self.engine.new_game()
-            await ws.send(json.dumps({"type": "new_game_ok"}))
-
-        elif cmd == "analyse":
-            fen      = msg.get("fen", "")
-            movetime = int(msg.get("movetime", 2000))
+            # Only the engine this client has been using holds its game;
+            # the others keep their hash for their own clients.
+            if session.affinity.engine is not None:
+                session.affinity.engine.new_game()
+            session.game.reset()
+            await reply({"type": "new_game_ok"})
+
+        elif cmd == "stats":
+            payload = {"type": "stats", "cache": self.cache.stats(),
+                       "coalesced": self.coalesced}
+            if self.book is not None:
+                payload["book"] = {"hits": self.book.hits}
+            if self.tablebase is not None:
+                payload["tablebase"] = {"hits": self.tablebase.hits}
+            if self.supervisor is not None:
+                payload["restarts"] = self.supervisor.restarts
+            payload["clients"]  = len(self._clients)
+            payload["timeouts"] = self.metrics.timeouts
+            await reply(payload)
+
+        elif cmd == "cancel":
+            handle = session.searches.get(str(request_id))
+            if handle is None:
+                await reply({"type": "error", "message": f"No running request: {request_id}"})
+                return
+            # The cancelled request still answers, with its partial result
+            handle.cancel()
+            await reply({"type": "cancel_ok"})
+
+        elif cmd in ("analyse", "analyse_stream"):
+            fen = msg.get("fen", "")
             if not fen:
-                await ws.send(json.dumps({"type": "error", "message": "Missing 'fen'"}))
+                await reply({"type": "error", "message": "Missing 'fen'"})
                 return
-            log.info("Analysing FEN: %s (movetime=%dms)", fen, movetime)
             try:
-                async with self._engine_lock:
-                    result = await self.engine.analyse(fen, movetime)
-
-                from_sq, to_sq, promo = uci_to_parts(result["bestmove"] or "")
-                side_to_move = fen.split()[1] if len(fen.split()) > 1 else "w"
-
-                await ws.send(json.dumps({
-                    "type":            "analysis",
-                    "fen":             fen,
-                    "bestmove":        result["bestmove"],
-                    "from":            from_sq,
-                    "to":              to_sq,
-                    "promotion":       promo,
-                    "score_cp":        result["score_cp"],
-                    "score_mate":      result["score_mate"],
-                    "pv":              result["pv"][:5],
-                    "depth":           result["depth"],
-                    "nodes":           result["nodes"],
-                    "feedback":        score_to_feedback(
-                                           result["score_cp"],
-                                           result["score_mate"],
-                                           side_to_move),
-                    "alternatives":    result.get("alternatives", []),
-                    "characteristics": result.get("characteristics"),
-                }))
+                budget   = self._budget(msg, 2000)
+                adaptive = self._time_policy(msg, budget)
+            except ValueError as e:
+                await reply({"type": "error", "message": str(e)})
+                return
+            log.info("Analysing FEN: %s (%s%s)", fen, budget,
+                     f", adaptive up to {adaptive.max_ms}ms" if adaptive else "")
+            # A newer position from the same client makes older analyses moot;
+            # one of this position with enough budget is joined instead
+            session.cancel_all(("analyse", "analyse_stream"),
+                               keep=None if cmd == "analyse_stream"
+                               else (fen, budget, adaptive is not None))
+            session.cancel_speculation(fen)
+            session.budgets["analyse"] = budget
+            key, handle = session.register(cmd, request_id)
+            handle.timings = timings
+            handle.search  = (normalise_fen(fen), budget, adaptive is not None)
+            try:
+                history = session.game.advance(fen)
+                result = self._book_lookup(msg, fen, self.book_analyse)
+                if result is None and cmd == "analyse_stream":
+                    interval = int(msg.get("interval", 100)) / 1000.0
+                    result = await self._search_streaming(session, handle, fen, budget,
+                                                          interval, history, adaptive)
+                elif result is None:
+                    result = await self._search(fen, budget, handle, history=history,
+                                                adaptive=adaptive)
+                session.game.note_result(fen, result)
+                payload = analysis_message(fen, result)
+                if handle.cancelled:
+                    payload["cancelled"] = True
+                elif handle.preempted:
+                    payload["preempted"] = True
+                if timings is not None:
+                    payload["timings"] = timings.as_dict(result)
+                await reply(payload)
+            except SearchCancelled:
+                await reply({"type": "error", "message": "Cancelled"})
             except asyncio.TimeoutError:
-                await ws.send(json.dumps({"type": "error", "message": "Engine timeout"}))
+                await reply({"type": "error", "message": "Engine timeout"})
+            except EngineCrashed as e:
+                await reply({"type": "error", "message": str(e)})
+            except websockets.exceptions.ConnectionClosed:
+                raise
             except Exception as e:
                 log.exception("Analysis error")
-                await ws.send(json.dumps({"type": "error", "message": str(e)}))
+                await reply({"type": "error", "message": str(e)})
+            finally:
+                session.unregister(key, handle)
+
+        elif cmd == "analyse_batch":
+            try:
+                budget = self._budget(msg, 1000)
+                if msg.get("pgn"):
+                    positions = pgn_positions(msg["pgn"])
+                else:
+                    positions = fen_list_positions(msg.get("fens") or [])
+            except ValueError as e:
+                await reply({"type": "error", "message": str(e)})
+                return
+            if not positions:
+                await reply({"type": "error", "message": "Missing 'fens' or 'pgn'"})
+                return
+            log.info("Batch analysis: %d positions (%s)", len(positions), budget)
+            key, handle = session.register(cmd, request_id)
+            try:
+                sent = await self._analyse_batch(session, handle, positions, budget)
+                await reply({"type": "batch_done", "count": sent,
+                             "cancelled": handle.cancelled})
+            finally:
+                session.unregister(key, handle)
 
         elif cmd == "engine_move":
-            fen      = msg.get("fen", "")
-            movetime = int(msg.get("movetime", 3000))
+            fen = msg.get("fen", "")
             if not fen:
-                await ws.send(json.dumps({"type": "error", "message": "Missing 'fen'"}))
+                await reply({"type": "error", "message": "Missing 'fen'"})
+                return
+            try:
+                budget   = self._budget(msg, 3000)
+                adaptive = self._time_policy(msg, budget)
+            except ValueError as e:
+                await reply({"type": "error", "message": str(e)})
                 return
-            log.info("Engine move for FEN: %s (movetime=%dms)", fen, movetime)
+            log.info("Engine move for FEN: %s (%s%s)", fen, budget,
+                     f", adaptive up to {adaptive.max_ms}ms" if adaptive else "")
+            session.cancel_speculation(fen)
+            session.budgets["engine_move"] = budget
+            key, handle = session.register(cmd, request_id)
+            handle.timings = timings
             try:
-                async with self._engine_lock:
-                    result = await self.engine.get_engine_move(fen, movetime)
+                history = session.game.advance(fen)
+                result = self._book_lookup(msg, fen, True, pick=True)
+                if result is None:
+                    result = await self._search(fen, budget, handle, history=history,
+                                                adaptive=adaptive)
+                session.game.note_result(fen, result)
                 from_sq, to_sq, promo = uci_to_parts(result["bestmove"] or "")
-                await ws.send(json.dumps({
+                payload = {
                     "type":       "engine_move",
                     "move":       result["bestmove"],
                     "from":       from_sq,
@@ -449,22 +2755,143 @@ class Lc0Server:
                     "score_cp":   result["score_cp"],
                     "score_mate": result["score_mate"],
                     "pv":         result["pv"][:5],
-                }))
+                }
+                if result.get("source"):
+                    payload["source"] = result["source"]
+                if handle.cancelled:
+                    payload["cancelled"] = True
+                if timings is not None:
+                    payload["timings"] = timings.as_dict(result)
+                await reply(payload)
+                if (self.prefetch or self.ponder) and result["bestmove"] and not handle.cancelled:
+                    session.spawn(self._speculate(session, fen, result))
+            except SearchCancelled:
+                await reply({"type": "error", "message": "Cancelled"})
             except asyncio.TimeoutError:
-                await ws.send(json.dumps({"type": "error", "message": "Engine timeout"}))
+                await reply({"type": "error", "message": "Engine timeout"})
+            except EngineCrashed as e:
+                await reply({"type": "error", "message": str(e)})
+            except websockets.exceptions.ConnectionClosed:
+                raise
             except Exception as e:
                 log.exception("Engine move error")
-                await ws.send(json.dumps({"type": "error", "message": str(e)}))
+                await reply({"type": "error", "message": str(e)})
+            finally:
+                session.unregister(key, handle)
 
         else:
-            await ws.send(json.dumps({"type": "error",
-                                       "message": f"Unknown command: {cmd}"}))
+            await reply({"type": "error", "message": f"Unknown command: {cmd}"})
+
+    def metrics_text(self) -> str:
+        cache = self.cache.stats()
+        gauges = {
+            "lc0_bridge_clients":              len(self._clients),
+            "lc0_bridge_cache_entries":        cache["entries"],
+            "lc0_bridge_cache_hits_total":     cache["hits"],
+            "lc0_bridge_cache_misses_total":   cache["misses"],
+            "lc0_bridge_cache_hit_ratio":      cache["hit_ratio"],
+            "lc0_bridge_coalesced_total":      self.coalesced,
+            "lc0_bridge_engine_restarts_total":
+                self.supervisor.restarts if self.supervisor else 0,
+        }
+        counts = self.pool.counts()
+        gauges["lc0_bridge_requests_waiting"] = counts.pop("waiting")
+        for state, n in counts.items():
+            gauges[f"lc0_bridge_engines_{state}"] = n
+        if self.book is not None:
+            gauges["lc0_bridge_book_hits_total"] = self.book.hits
+        if self.tablebase is not None:
+            gauges["lc0_bridge_tablebase_hits_total"] = self.tablebase.hits
+        return self.metrics.render(gauges)
+
+    async def _serve_metrics(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter):
+        """Minimal HTTP/1.0 responder: GET /metrics, anything else is a 404."""
+        try:
+            request = (await asyncio.wait_for(reader.readline(), 5)).decode(errors="replace")
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass   # headers
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.metrics_text()
+            else:
+                status, body = "404 Not Found", "Not found\n"
+            data = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\n"
+                         "Content-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
 
     async def run(self):
-        log.info("WebSocket server on ws://%s:%d", self.host, self.port)
-        async with websockets.serve(self.handle, self.host, self.port):
-            log.info("Server live — waiting for connections")
-            await asyncio.Future()
+        log.info("WebSocket server on ws://%s:%d (%d engine%s)", self.host, self.port,
+                 len(self.pool), "" if len(self.pool) == 1 else "s")
+        metrics = None
+        if self.metrics_port:
+            metrics = await asyncio.start_server(self._serve_metrics, self.host,
+                                                 self.metrics_port)
+            log.info("Metrics on http://%s:%d/metrics", self.host, self.metrics_port)
+        try:
+            async with websockets.serve(self.handle, self.host, self.port):
+                log.info("Server live — waiting for connections")
+                await asyncio.Future()
+        finally:
+            if metrics is not None:
+                metrics.close()
+
+
+# ── Engine Warmup ─────────────────────────────────────────────────────────────
+
+# Common openings: the first searches of the day are usually around here
+WARMUP_FENS = [
+    START_FEN,
+    "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1",          # 1. e4
+    "rnbqkbnr/pppppppp/8/8/3P4/8/PPP1PPPP/RNBQKBNR b KQkq - 0 1",          # 1. d4
+    "rnbqkbnr/pp1ppppp/8/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2",      # Sicilian
+    "r1bqkbnr/pppp1ppp/2n5/1B2p3/4P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3",   # Ruy Lopez
+    "rnbqkb1r/pppp1ppp/4pn2/8/2PP4/8/PP2PPPP/RNBQKBNR w KQkq - 0 3",       # 1. d4 Nf6 2. c4 e6
+]
+
+
+def load_warmup_fens(path: str) -> list:
+    """One FEN per line; blank lines and lines starting with # are skipped."""
+    with open(path, encoding="utf-8") as f:
+        fens = [line.strip() for line in f]
+    fens = [fen for fen in fens if fen and not fen.startswith("#")]
+    if not fens:
+        raise ValueError(f"No positions in {path}")
+    return fens
+
+
+async def warmup(engines: list, fens: list, nodes: int, deadline_ms: int):
+    """
+    Search every position on every engine (side by side) with a small node
+    budget, so lc0's backend and NN cache are initialised before the first
+    real request rather than during it. Results are thrown away.
+    """
+    async def warm(engine: UCIEngine):
+        started = time.monotonic()
+        first   = None
+        for fen in fens:
+            t0 = time.monotonic()
+            try:
+                await engine.analyse(fen, budget=SearchBudget("nodes", nodes, deadline_ms))
+            except (asyncio.TimeoutError, EngineCrashed) as e:
+                log.warning("%s warmup failed on %s: %s", engine.name, fen,
+                            e or "timeout")
+                break
+            if first is None:
+                first = time.monotonic() - t0
+        engine.new_game()
+        log.info("%s warmed up in %.2fs (first position %.2fs)", engine.name,
+                 time.monotonic() - started, first or 0.0)
+
+    log.info("Warming up on %d position%s (%d nodes each) …", len(fens),
+             "" if len(fens) == 1 else "s", nodes)
+    await asyncio.gather(*(warm(engine) for engine in engines))
 
 
 # ── Entry Point ───────────────────────────────────────────────────────────────
@@ -475,28 +2902,136 @@ def parse_args():
     p.add_argument("--weights", default=None,               help="Path to weights (.pb.gz)")
     p.add_argument("--port",    type=int, default=8765,     help="WebSocket port")
     p.add_argument("--host",    default="0.0.0.0",          help="Bind address")
-    p.add_argument("--threads", type=int, default=4,        help="UCI Threads option")
+    p.add_argument("--threads", type=int, default=4,        help="UCI Threads option (per engine)")
+    p.add_argument("--engines", type=int, default=1,        help="Number of lc0 processes in the pool")
+    p.add_argument("--preempt", action="store_true",
+                   help="Stop a running analysis when an engine_move is waiting")
+    p.add_argument("--starvation-ms", type=int, default=5000,
+                   help="Serve any request that has waited this long next")
+    p.add_argument("--adaptive", action="store_true",
+                   help="Adaptive movetime unless a request sets \"adaptive\": false")
+    p.add_argument("--max-search-ms", type=int, default=30000,
+                   help="Default deadline for nodes/depth/infinite requests")
+    p.add_argument("--mate-stable", type=int, default=3,
+                   help="Stop once slot 1 reports the same mate this many times (0: never)")
+    p.add_argument("--only-move-nodes", type=int, default=100,
+                   help="Stop a search with a single legal move after this many nodes (0: never)")
+    p.add_argument("--stall-ms", type=int, default=5000,
+                   help="Send isready to an engine silent this long in a search, and "
+                        "restart it if that goes unanswered as long (0 = never)")
+    p.add_argument("--book",    default=None,               help="Polyglot opening book (.bin)")
+    p.add_argument("--book-analyse", action="store_true",
+                   help="Answer analyse requests from the book as well as engine_move")
+    p.add_argument("--syzygy",  default=None,
+                   help="Syzygy tablebase directory (several joined with the OS path separator)")
+    p.add_argument("--prefetch", type=int, default=0,
+                   help="After engine_move, search this many likely replies ahead")
+    p.add_argument("--ponder",  action="store_true",
+                   help="After engine_move, ponder on the likeliest reply (go ponder)")
+    p.add_argument("--warmup",  type=int, default=0,
+                   help="Before accepting connections, search the warmup positions "
+                        "with this many nodes each (0 = no warmup)")
+    p.add_argument("--warmup-fens", default=None,
+                   help="File of warmup positions, one FEN per line (default: common openings)")
+    p.add_argument("--metrics-port", type=int, default=0,
+                   help="Serve Prometheus metrics at http://host:PORT/metrics (0 = off)")
+    p.add_argument("--cache-size", type=int, default=4096,  help="Max cached positions (0 disables)")
+    p.add_argument("--cache-ttl",  type=float, default=3600, help="Seconds a cached analysis stays valid")
+    p.add_argument("--store",   default=os.path.join(os.path.dirname(__file__), "lc0_analysis.db"),
+                   help="SQLite file that keeps analyses across restarts")
+    p.add_argument("--no-store", action="store_true",      help="Disable the on-disk analysis store")
+    p.add_argument("--log-file", default=os.path.join(os.path.dirname(__file__), "lc0_server.log"),
+                   help="Log file (rotated by size)")
+    p.add_argument("--log-max-mb", type=float, default=10, help="Rotate the log file at this size")
+    p.add_argument("--log-backups", type=int, default=5,    help="Rotated log files to keep")
+    p.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                   help="DEBUG also logs UCI traffic to and from lc0")
+    p.add_argument("--log-uci-every", type=int, default=1,
+                   help="At DEBUG, log only every Nth lc0 info line (the bulk of the traffic)")
     return p.parse_args()
 
 
 async def main():
-    args   = parse_args()
-    engine = UCIEngine(lc0_path=args.lc0, model_path=args.weights)
-    loop   = asyncio.get_running_loop()
-    engine.start(loop)
-
-    log.info("Waiting for UCI handshake …")
-    await engine.wait_ready()
-
-    # setoption must come after readyok, before any position/go
-    engine.set_option("Threads", str(args.threads))
-    engine.set_option("MultiPV",  str(MULTI_PV))
+    args    = parse_args()
+    setup_logging(args.log_file, getattr(logging, args.log_level),
+                  max_bytes=int(args.log_max_mb * (1 << 20)), backups=args.log_backups)
+    early   = EarlyStop(mate_updates=args.mate_stable,
+                        only_move_nodes=args.only_move_nodes)
+    engines = [UCIEngine(lc0_path=args.lc0, model_path=args.weights,
+                         name=f"lc0#{i + 1}", early_stop=early,
+                         stall_after=args.stall_ms / 1000.0,
+                         info_log_every=args.log_uci_every)
+               for i in range(max(1, args.engines))]
+    pool    = EnginePool(engines, starvation_after=args.starvation_ms / 1000.0,
+                         preempt=args.preempt)
+    cache   = PositionCache(max_entries=args.cache_size, max_age=args.cache_ttl)
+    store   = None
+    book    = None
+    supervisor = None
+    if args.book:
+        try:
+            book = OpeningBook(args.book)
+            log.info("Opening book: %s", args.book)
+        except (OSError, ValueError) as e:
+            log.error("Opening book disabled: %s", e)
+    tablebase = None
+    if args.syzygy:
+        try:
+            tablebase = Tablebase(args.syzygy)
+            log.info("Syzygy tablebases: %s (up to %d pieces)", args.syzygy,
+                     tablebase.max_pieces)
+        except (OSError, ValueError) as e:
+            log.error("Tablebase probing disabled: %s", e)
+    await asyncio.gather(*(engine.start() for engine in engines))
 
-    server = Lc0Server(engine, host=args.host, port=args.port)
     try:
+        log.info("Waiting for UCI handshake …")
+        await asyncio.gather(*(engine.wait_ready() for engine in engines))
+
+        # setoption must come after readyok, before any position/go
+        for engine in engines:
+            engine.set_option("Threads", str(args.threads))
+            engine.set_option("MultiPV",  str(MULTI_PV))
+            if args.syzygy:
+                engine.set_option("SyzygyPath", args.syzygy)
+        supervisor = EngineSupervisor(pool)
+        supervisor.start()
+
+        if args.warmup > 0:
+            fens = WARMUP_FENS
+            if args.warmup_fens:
+                try:
+                    fens = load_warmup_fens(args.warmup_fens)
+                except (OSError, ValueError) as e:
+                    log.error("Warmup positions: %s — using the built-in openings", e)
+            await warmup(engines, fens, args.warmup, args.max_search_ms)
+
+        if not args.no_store:
+            store = AnalysisStore(args.store, weights=weights_fingerprint(args.weights))
+            await store.open()
+            rows = await store.load(limit=args.cache_size)
+            for fen, budget, result in rows:
+                cache.put(fen, budget, result)
+            log.info("Loaded %d stored analyses into the cache", len(rows))
+
+        server = Lc0Server(pool, host=args.host, port=args.port,
+                           cache=cache, store=store, adaptive=args.adaptive,
+                           max_search_ms=args.max_search_ms,
+                           book=book, book_analyse=args.book_analyse,
+                           tablebase=tablebase, prefetch=args.prefetch,
+                           ponder=args.ponder, supervisor=supervisor,
+                           metrics_port=args.metrics_port)
         await server.run()
     finally:
-        engine.stop()
+        if supervisor:
+            await supervisor.stop()
+        if store:
+            await store.close()
+        if book:
+            book.close()
+        if tablebase:
+            tablebase.close()
+        await pool.stop()
 
 
 if __name__ == "__main__":
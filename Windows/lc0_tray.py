@@ -43,7 +43,11 @@ def load_config() -> dict:
         "lc0": r"C:\lc0\lc0.exe",
         "port": "8765",
         "threads": "4",
+        "engines": "1",
         "weights": "",
+        "book": "",
+        "syzygy": "",
+        "warmup": "0",
     }
     if CONFIG_FILE.exists():
         for line in CONFIG_FILE.read_text().splitlines():
@@ -87,9 +91,16 @@ class ServerManager:
             cmd = [PYTHON_EXE, str(SERVER_SCRIPT),
                    "--lc0", cfg["lc0"],
                    "--port", cfg["port"],
-                   "--threads", cfg["threads"]]
+                   "--threads", cfg["threads"],
+                   "--engines", cfg["engines"]]
             if cfg["weights"]:
                 cmd += ["--weights", cfg["weights"]]
+            if cfg["book"]:
+                cmd += ["--book", cfg["book"]]
+            if cfg["syzygy"]:
+                cmd += ["--syzygy", cfg["syzygy"]]
+            if cfg["warmup"] not in ("", "0"):
+                cmd += ["--warmup", cfg["warmup"]]
 
             # Open a new console window so you can see output (remove creationflags to hide)
             self._proc = subprocess.Popen(